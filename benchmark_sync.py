@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+'''
+Benchmark of sync_rdmo_projects.py against a local fake RDMO API, no live instance or token needed.
+Call with `python benchmark_sync.py --projects 500 --values 50 --touch 0.1`.
+Two scenarios are run in a temporary directory: `initial` (empty directory) and `incremental`
+(after `--touch` of the projects changed on the server). For each one the report gives projects/s,
+bytes/s served by the fake API, git commit time and the peak RSS of the sync process.
+`--latency` and `--errors` add a delay and a rate of 429/500 answers to every request,
+`--json FILE` saves the results to compare runs. Other RDMO_* variables are passed to the sync script.
+'''
+import os
+import re
+import sys
+import json
+import random
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+from time import perf_counter, sleep
+from datetime import datetime, timedelta, timezone
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+SYNC_SCRIPT = Path(__file__).resolve().parent / "sync_rdmo_projects.py"
+TOKEN = "benchmark"
+BASE_DATE = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+##########################################################################################################################################################################################################################################################################################
+####   Faux serveur RDMO
+##########################################################################################################################################################################################################################################################################################
+
+
+class FakeRDMO:
+    """État du faux serveur : projets synthétiques (id, titre, last_changed, version des valeurs)
+    et compteurs de ce qui a été servi."""
+
+    def __init__(self, projects, page_size, values, value_size, latency, errors, seed=0):
+        self.page_size = page_size
+        self.values_per_project = values
+        self.value_size = value_size
+        self.latency = latency
+        self.errors = errors
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.version = {pid: 0 for pid in range(1, projects + 1)}
+        self.changed = {pid: BASE_DATE + timedelta(seconds=pid) for pid in self.version}
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.bytes_sent = 0
+            self.requests = 0
+            self.injected_errors = 0
+
+    def touch(self, fraction):
+        """Modifie les valeurs d'une fraction des projets. Retourne leurs ids."""
+        count = round(len(self.version) * fraction)
+        touched = self.random.sample(sorted(self.version), count)
+        now = max(self.changed.values())
+        for i, pid in enumerate(touched, 1):
+            self.version[pid] += 1
+            self.changed[pid] = now + timedelta(seconds=i)
+        return touched
+
+    def project(self, pid):
+        return {"id": pid, "title": f"Projet {pid}", "last_changed": self.changed[pid].isoformat().replace("+00:00", "Z")}
+
+    def listing(self, query, base_url):
+        ordering = query.get("ordering", [""])[0]
+        page = int(query.get("page", ["1"])[0])
+        pids = sorted(self.version, key=self.changed.get, reverse=ordering == "-last_changed")
+        results = [self.project(pid) for pid in pids[(page - 1) * self.page_size:page * self.page_size]]
+        next_url = None
+        if page * self.page_size < len(pids):
+            next_url = f"{base_url}?page={page + 1}" + (f"&ordering={ordering}" if ordering else "")
+        return {"count": len(pids), "next": next_url, "previous": None, "results": results}
+
+    def values(self, pid):
+        version = self.version[pid]
+        text = f"projet {pid} version {version} ".ljust(self.value_size, "x")
+        return [
+            {
+                "id": pid * 100000 + k,
+                "attribute": k,
+                "set_prefix": "",
+                "set_index": 0,
+                "collection_index": 0,
+                "text": text,
+                "value_type": "text",
+                "updated": self.changed[pid].isoformat(),
+            }
+            for k in range(self.values_per_project)
+        ]
+
+
+class FakeRDMOHandler(BaseHTTPRequestHandler):
+    """Routes de l'API utilisées par la synchronisation : listing paginé, fiche projet et /values."""
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def do_GET(self):
+        fake = self.fake
+        if fake.latency:
+            sleep(fake.latency)
+        if self.headers.get("Authorization") != f"Token {TOKEN}":
+            return self.send_json(401, {"detail": "Invalid token."})
+        if fake.errors and fake.random.random() < fake.errors:
+            with fake.lock:
+                fake.injected_errors += 1
+            return self.send_json(fake.random.choice([429, 500]), {"detail": "injected"}, {"Retry-After": "0"})
+
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")  # api v1 projects projects [id [values]]
+        if parts[:4] != ["api", "v1", "projects", "projects"]:
+            return self.send_json(404, {"detail": "Not found."})
+        if len(parts) == 4:
+            base_url = f"http://{self.headers.get('Host')}{url.path}"
+            return self.send_json(200, fake.listing(parse_qs(url.query), base_url))
+        if not parts[4].isdigit() or int(parts[4]) not in fake.version:
+            return self.send_json(404, {"detail": "Not found."})
+        pid = int(parts[4])
+        if len(parts) == 5:
+            return self.send_json(200, fake.project(pid))
+        if parts[5:] == ["values"]:
+            return self.send_json(200, fake.values(pid))
+        return self.send_json(404, {"detail": "Not found."})
+
+    def send_json(self, code, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.fake.lock:
+            self.fake.requests += 1
+            self.fake.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(fake):
+    """Lance le faux serveur sur un port libre de 127.0.0.1. Retourne (serveur, url de base)."""
+    handler = type("Handler", (FakeRDMOHandler,), {"fake": fake})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+##########################################################################################################################################################################################################################################################################################
+####   Scénarios
+##########################################################################################################################################################################################################################################################################################
+
+
+def run_sync(workdir, base_url, log_file):
+    """Lance une synchronisation dans workdir. Retourne (code de sortie, durée, RSS max en octets)."""
+    env = dict(os.environ, TOKENRDMO=TOKEN, MYRDMO=base_url)
+    # le limiteur de débit ne doit pas être le goulot d'étranglement mesuré, sauf demande explicite
+    env.setdefault("RDMO_RATE", "100")
+    env.setdefault("RDMO_RATE_MAX", "1000")
+    with open(log_file, "w", encoding="utf-8") as log:
+        started = perf_counter()
+        process = subprocess.Popen([sys.executable, str(SYNC_SCRIPT)], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 donne les ressources de ce processus seulement (ru_maxrss en Ko sous Linux)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, elapsed, usage.ru_maxrss * 1024
+
+
+def parse_log(log_file):
+    """Projets synchronisés, commits et temps git cumulé, lus dans le résumé du script."""
+    text = Path(log_file).read_text(encoding="utf-8")
+    synced = re.search(r"\[RÉSUMÉ\] (\d+) projet\(s\) synchronisé\(s\), (\d+) échec", text)
+    commits = re.search(r"\[RÉSUMÉ\] (\d+) commit\(s\) git .* temps git cumulé ([\d.]+) s", text)
+    return {
+        "synced": int(synced.group(1)) if synced else 0,
+        "failures": int(synced.group(2)) if synced else 0,
+        "commits": int(commits.group(1)) if commits else 0,
+        "git_seconds": float(commits.group(2)) if commits else 0.0,
+    }
+
+
+def scenario(name, fake, workdir, base_url):
+    fake.reset_counters()
+    log_file = Path(workdir) / f"benchmark_{name}.log"
+    returncode, elapsed, peak_rss = run_sync(workdir, base_url, log_file)
+    result = dict(parse_log(log_file), scenario=name, returncode=returncode, seconds=elapsed, peak_rss=peak_rss,
+                  bytes=fake.bytes_sent, requests=fake.requests, injected_errors=fake.injected_errors)
+    result["projects_per_second"] = result["synced"] / elapsed if elapsed else 0.0
+    result["bytes_per_second"] = fake.bytes_sent / elapsed if elapsed else 0.0
+    print(f"[RÉSUMÉ] {name:<11} : {result['synced']} projet(s) en {elapsed:.1f} s, "
+          f"{result['projects_per_second']:.1f} projets/s, {result['bytes_per_second'] / 1e6:.2f} Mo/s, "
+          f"git {result['git_seconds']:.1f} s ({result['commits']} commits), RSS max {peak_rss / 1e6:.0f} Mo, "
+          f"{result['requests']} requêtes ({result['injected_errors']} erreurs injectées), code {returncode}")
+    if returncode != 0 or result["failures"]:
+        print(f"[ERREUR] {name} : voir {log_file}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de sync_rdmo_projects.py sur un faux serveur RDMO local")
+    parser.add_argument("--projects", type=int, default=200, help="nombre de projets sur le serveur")
+    parser.add_argument("--page-size", type=int, default=50, help="taille des pages du listing")
+    parser.add_argument("--values", type=int, default=50, help="valeurs par projet")
+    parser.add_argument("--value-size", type=int, default=200, help="taille du texte de chaque valeur (octets)")
+    parser.add_argument("--latency", type=float, default=0.0, help="délai ajouté à chaque requête (s)")
+    parser.add_argument("--errors", type=float, default=0.0, help="proportion de réponses 429/500 injectées")
+    parser.add_argument("--touch", type=float, default=0.1, help="proportion de projets modifiés avant l'incrémental")
+    parser.add_argument("--workdir", help="dossier de travail (temporaire par défaut, conservé)")
+    parser.add_argument("--json", help="fichier où enregistrer les résultats")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rdmo_benchmark_")
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    fake = FakeRDMO(args.projects, args.page_size, args.values, args.value_size, args.latency, args.errors)
+    server, base_url = start_server(fake)
+    print(f"[INFO] Faux serveur RDMO sur {base_url}, {args.projects} projets, dossier {workdir}")
+
+    results = [scenario("initial", fake, workdir, base_url)]
+    touched = fake.touch(args.touch)
+    print(f"[INFO] {len(touched)} projet(s) modifié(s) sur le serveur")
+    results.append(scenario("incremental", fake, workdir, base_url))
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2)
+        print(f"[INFO] Résultats enregistrés dans {args.json}")
+    return 1 if any(r["returncode"] != 0 or r["failures"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
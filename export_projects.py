@@ -1,247 +1,211 @@
 '''
-Put in `/path/to/rdmo-app/scripts/export_projects.py`.
+Put in `/path/to/rdmo-app/scripts/export_projects.py`, together with `rdmo_common.py` (shared helpers).
 Call with `./manage.py runscript export_projects --script-args ~/rdmo_exports`.
+Only projects changed since the last export are processed, add `full` to force a full export:
+`./manage.py runscript export_projects --script-args ~/rdmo_exports full`.
+The API listing (`liste_projet.json`) is only downloaded and published on a full export.
+Add `workers=N` to render the project XML on N processes.
+The XML is written in canonical form (sorted values, no export/save timestamps) so that unchanged projects produce no diff.
+Rendered catalogs are cached in `<path>/.catalog_cache` across runs (`catalog_cache=DIR`, `catalog_cache_mb=N`).
+Add `shared_catalogs` to store each catalog version once in `<path>/catalogs` and give projects a `catalog.ref` pointer.
+Add `projects=ID,ID` to export only these projects (e.g. from a change notification), leaving the watermark as is.
+Add `monorepo` (and optionally `batch=N`) to version all projects in a single repository at `<path>`,
+committed in batches of N projects; `git log -- <id>/` gives the history of one project.
+Project repositories are committed on 4 threads (`commit_workers=N`).
+Per-phase timings and counters are printed at the end; `metrics_json=FILE` and `metrics_prom=FILE` also save them
+as a JSON report and a Prometheus textfile.
+In monorepo mode, batches of `fast_import_threshold=N` projects or more (default 200) are committed with `git fast-import`.
 '''
 
 from pathlib import Path
 
-from django.contrib.auth.models import User
-from django.test import RequestFactory
+from django.utils import timezone as django_timezone
 
-from rdmo.core.exports import XMLResponse
 from rdmo.projects.models import Project
-from rdmo.projects.views import ProjectExportView
-from rdmo.questions.models import Catalog
-from rdmo.questions.renderers import CatalogRenderer
-from rdmo.questions.serializers.export import CatalogExportSerializer
 
 import os
+import sys
 import json
-import shutil
-import subprocess
 import traceback
-import requests
-from pathlib import Path
-from datetime import datetime
-from git import Repo
+from concurrent.futures import ThreadPoolExecutor
+
+# fonctions communes aux scripts (rdmo_common.py, à côté de ce script dans rdmo-app/scripts) :
+# runscript importe ce script comme scripts.export_projects, son dossier n'est pas dans sys.path
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from rdmo_common import (
+    CATALOG_POINTER, LISTING_HEADER, METRICS, MonorepoBatch, changed_catalogs, changed_projects, export_catalog, finish_export,
+    forget_blobs, git_commit, iter_remote_projects, parse_options, read_watermark, record_export_commit,
+    refresh_catalog_store, render_projects, shared_catalog_pointer, start_export, write_if_changed, write_watermark,
+)
 
 
 ##########################################################################################################################################################################################################################################################################################
 ####   Récupère les variables d'environnement
 ##########################################################################################################################################################################################################################################################################################
 
-TOKEN = os.environ["tokenrdmo"]
-MYRDMO = os.environ["myrdmo"]
-
-HEADERS = {"Authorization": f"Token {TOKEN}"}
-LISTE_PROJET_URL = f"{MYRDMO}/api/v1/projects/projects/"
+# listing de l'API publié par un export complet ; tokenrdmo et myrdmo (ou TOKENRDMO et MYRDMO) sont lus
+# dans rdmo_common, à l'import mais utilisés seulement par ce listing
 LISTE_FILE = "/var/www/rdmo/rdmo-app/static_root/rdmo_project_export/liste_projet.json"
-OLD_LISTE_FILE = "/var/www/rdmo/rdmo-app/static_root/rdmo_project_export/old_liste_projet.json"
-
 
 ##########################################################################################################################################################################################################################################################################################
 ####   definition des fonctions
 ##########################################################################################################################################################################################################################################################################################
 
-def run_curl(url, output_file):
-    cmd = [
-        "curl", "-s", "-w", "%{http_code}", "-LH", f"Authorization: Token {TOKEN}", url
-    ]
-    try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        http_code = result.stdout[-3:]
-        body = result.stdout[:-3]
-
-        if http_code != "200":
-            print(f"[ERREUR] Code HTTP {http_code} pour {url}")
-            print(f"[DEBUG] Réponse : {body[:500]}...")  # Tronque pour pas spammer
-            raise Exception(f"Échec HTTP {http_code}")
-
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(body)
-
-    except subprocess.CalledProcessError as e:
-        print(f"[ERREUR] curl a échoué pour {url}")
-        raise
+def write_listing(filename, projects):
+    """Écrit un listing {"results": [...]} au fil de l'eau, un projet par ligne.
+    Le fichier est écrit à côté puis renommé : un listing interrompu n'écrase pas l'ancien."""
+    tmp_file = f"{filename}.tmp"
+    count = 0
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(LISTING_HEADER + "\n")
+        for proj in projects:
+            if count:
+                f.write(",\n")
+            f.write(json.dumps(proj, ensure_ascii=False))
+            count += 1
+        f.write("\n]}\n")
+    os.replace(tmp_file, filename)
+    return count
 
 
-def safe_title(title):
-    return title.replace(" ", "_").replace("/", "-")
-
 def fetch_all_projects():
-    headers = {"Authorization": f"Token {TOKEN}"}
-    url = LISTE_PROJET_URL
-    all_results = []
-
-    while url:
-        #print(f"[INFO] Téléchargement de {url}")
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            print(f"[ERREUR] Code HTTP {response.status_code} pour {url}")
-            print(f"[DEBUG] Réponse : {response.text[:500]}...")
-            raise Exception(f"Échec HTTP {response.status_code}")
-
-        data = response.json()
-        all_results.extend(data.get("results", []))
-        url = data.get("next")
-
-    with open(LISTE_FILE, "w", encoding="utf-8") as f:
-        json.dump({"results": all_results}, f, ensure_ascii=False, indent=2)
-
-
-def parse_projects(filename):
-    with open(filename, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return {
-        proj["id"]: {
-            "title": proj["title"],
-            "last_changed": proj["last_changed"]
-        }
-        for proj in data["results"]
-    }
-
-def download_and_commit_project(project_id, title):
-    from time import sleep
-
-    folder = Path(f"{project_id}_{safe_title(title)}")
-    folder.mkdir(exist_ok=True)
-    output_file = folder / f"{safe_title(title)}.json"
-
-    url = f"{MYRDMO}/api/v1/projects/projects/{project_id}/values"
-    run_curl(url, str(output_file))
-
-    sleep(0.5)  # Pour éviter les problèmes de détection de fichier
-    if not output_file.exists():
-        print(f"[ERREUR] Le fichier {output_file} n’a pas été créé.")
-        return
+    count = write_listing(LISTE_FILE, iter_remote_projects())
+    print(f"[INFO] {count} projets enregistrés dans {LISTE_FILE}")
 
-    if not (folder / ".git").exists():
-        repo = Repo.init(folder)
-    else:
-        repo = Repo(folder)
 
-    original_dir = os.getcwd()
+def commit_project(project_folder, files, project):
+    """Commit les fichiers modifiés du projet (project.xml, catalog.xml ou catalog.ref) dans le dépôt git
+    du projet (initialisé si besoin), sans os.chdir : appelé depuis les threads de commit.
+    Le commit est daté de la dernière modification RDMO du projet et enregistré dans l'index des commits.
+    Les fichiers supprimés sont retirés du dépôt. Retourne False si le commit a échoué."""
+    changes = {f.name: f.read_bytes() if f.exists() else None for f in files}
+    date = project.updated if project.updated.tzinfo else project.updated.astimezone()
     try:
-        os.chdir(folder)
-        repo.index.add([output_file.name])
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        repo.index.commit(f"Update on {now}")
+        sha = git_commit(project_folder, changes, f"Update on {date.strftime('%Y-%m-%d %H:%M:%S')}",
+                         author_date=date, commit_date=date)
     except Exception as e:
-        print(f"[ERREUR] Git add/commit a échoué pour {output_file} : {e}")
-        print(f"[DEBUG] Répertoire courant : {os.getcwd()}")
-        import traceback
+        print(f"[ERREUR] Git add/commit a échoué pour {project_folder} : {e}")
         traceback.print_exc()
-    finally:
-        os.chdir(original_dir)
-
+        forget_blobs(files)
+        return False
+    record_export_commit(project_folder, sha, [(project, files)])
+    return True
 
-def commit_project(project_folder,project_xml_path):
-    ##init the git 
-    if not (project_folder / ".git").exists():
-        repo = Repo.init(project_folder)
-    else:
-        repo = Repo(project_folder)
-
-    original_dir = os.getcwd()
-    try:
-        os.chdir(project_folder)
-        repo.index.add([project_xml_path.name])
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        repo.index.commit(f"Update on {now}")
-    except Exception as e:
-        print(f"[ERREUR] Git add/commit a échoué pour {project_xml_path} : {e}")
-        print(f"[DEBUG] Répertoire courant : {os.getcwd()}")
-        import traceback
-        traceback.print_exc()
-    finally:
-        os.chdir(original_dir)
 
 ##########################################################################################################################################################################################################################################################################################
 ####   Début du script
 ##########################################################################################################################################################################################################################################################################################
 
-
-# Étape 1 : Télécharger tous les projets paginés
-fetch_all_projects()
-
-
-# Étape 2 : Extraire les projets
-projects_json = parse_projects(LISTE_FILE)
-
-# dict to cache the rendered catalogs
-catalogs = {}
-
-def run(path):
-
-
+def run(path=None, *args):
     base_path = Path.cwd() / 'projects' if path is None else Path(path)
     projects = Project.objects.all()
-
-    if not Path(OLD_LISTE_FILE).exists():
-        shutil.move(LISTE_FILE, OLD_LISTE_FILE)
-        for project in projects:
+    options = parse_options(args)
+    exporter = start_export(base_path, options)
+    since = None if options.get('full') else read_watermark(base_path)
+    # projects=ID,ID... : seulement ces projets (ex. sur notification), sans toucher au watermark
+    only = [int(pid) for pid in str(options['projects']).split(',')] if options.get('projects') else None
+    started = django_timezone.now()
+    workers = int(options.get('workers', 1))
+    shared_catalogs = bool(options.get('shared_catalogs'))
+    fast_import_threshold = int(options.get('fast_import_threshold', 200))
+    batch = MonorepoBatch(base_path, int(options.get('batch', 500)), fast_import_threshold) if options.get('monorepo') else None
+    # les dépôts des projets sont commités en parallèle pendant que la boucle continue
+    committer = ThreadPoolExecutor(max_workers=int(options.get('commit_workers', 4)))
+
+    commits = []
+    # catalogues modifiés depuis le dernier export, calculé avant tout rendu de catalogue
+    refreshed_catalogs = changed_catalogs(base_path)
+
+    def commit(project, project_path, files):
+        if batch is not None:
+            batch.add(f"{project.id} ({project.title})", files, project.updated, project)
+        else:
+            commits.append(committer.submit(commit_project, project_path, files, project))
+
+    def write_catalog(project, project_path):
+        """Écrit le pointeur catalog.ref (shared_catalogs), ou catalog.xml : toujours en export complet,
+        sinon s'il manque ou si le catalogue a changé. Retourne les fichiers à commiter."""
+        files = []
+        catalog_xml_path = project_path / 'catalog.xml'
+        if shared_catalogs:
+            with exporter.count_queries('catalog'):
+                catalog_ref = shared_catalog_pointer(base_path, project.catalog_id, batch)
+            if write_if_changed(project_path / CATALOG_POINTER, catalog_ref):
+                files.append(project_path / CATALOG_POINTER)
+            if catalog_xml_path.exists():
+                # ancienne copie complète, remplacée par le pointeur
+                catalog_xml_path.unlink()
+                files.append(catalog_xml_path)
+        elif since is None or not catalog_xml_path.exists() or project.catalog_id in refreshed_catalogs:
+            with exporter.count_queries('catalog'):
+                catalog_xml = export_catalog(project.catalog_id)
+            if write_if_changed(catalog_xml_path, catalog_xml):
+                files.append(catalog_xml_path)
+        return files
+
+    if since is not None or only is not None:
+        # Mode incrémental : la base ne renvoie que les projets modifiés depuis le dernier export
+        # (ou seulement les projets demandés). Le watermark est le seul détecteur de changements :
+        # pas de listing de l'API, le coût suit le nombre de projets modifiés
+        with exporter.count_queries('listing'), METRICS.timer('listing'):
+            projects = list(Project.objects.filter(id__in=only) if only is not None else changed_projects(since))
+            # projets inchangés dont le catalogue a changé : seuls leurs fichiers de catalogue sont rafraîchis.
+            # Avec shared_catalogs, leur pointeur ne change pas : seul le dépôt partagé des catalogues est mis à jour
+            catalog_projects = []
+            if only is None and not shared_catalogs:
+                project_ids = {project.id for project in projects}
+                catalog_projects = [
+                    project for project in Project.objects.filter(catalog_id__in=refreshed_catalogs)
+                    if project.id not in project_ids
+                ]
+        if only is None and shared_catalogs:
+            with exporter.count_queries('catalog'):
+                refresh_catalog_store(base_path, refreshed_catalogs, batch)
+        project_xmls = render_projects([project.id for project in projects], workers)
+        for project, project_xml in [*zip(projects, project_xmls), *((project, None) for project in catalog_projects)]:
+            if project_xml is None:
+                print(f"[UPDATE] catalogue de {project.title} modifié")
+            else:
+                print(f"[UPDATE] {project.title} a changé (depuis {since})" if only is None else f"[UPDATE] {project.title} demandé")
             project_path = base_path / str(project.id)
             project_path.mkdir(exist_ok=True, parents=True)
 
             project_xml_path = project_path / 'project.xml'
-            if not project_xml_path.exists():
-                project_xml = export_project(project.id)
-                with project_xml_path.open('w') as fp:
-                    fp.write(project_xml)
-
-            catalog_xml_path = project_path / 'catalog.xml'
-            if not catalog_xml_path.exists():
-                catalog_xml = export_catalog(project.catalog.id)
-                with catalog_xml_path.open('w') as fp:
-                    fp.write(catalog_xml)
-            commit_project(project_path,project_xml_path)
+            files = [project_xml_path] if project_xml is not None and write_if_changed(project_xml_path, project_xml) else []
+            files += write_catalog(project, project_path)
+            if files:
+                commit(project, project_path, files)
+            else:
+                print(f"[SKIP] project.xml inchangé pour {project.title}")
     else:
-        old_projects = parse_projects(OLD_LISTE_FILE)
-        for pid, info in projects_json.items():
-            title = info["title"]
-            new_date = info["last_changed"]
-            old_date = old_projects.get(pid, {}).get("last_changed")
-
-            if old_date != new_date:
-                print(f"[UPDATE] {title} a changé ({old_date} -> {new_date})")
-                project_path = base_path / str(pid)
-                project_path.mkdir(exist_ok=True, parents=True)
-
-                project_xml_path = project_path / 'project.xml'
-                project_xml = export_project(pid)
-                with project_xml_path.open('w') as fp:
-                    fp.write(project_xml)
-                commit_project(project_path,project_xml_path)
-            #else:
-            #    print(f"[SKIP] {title} pas modifié")
-        
-    # Mise à jour du fichier de référence
-    shutil.copyfile(LISTE_FILE, OLD_LISTE_FILE)
-
-def export_project(project_id):
-    factory = RequestFactory()
-    request = factory.get('/dummy-url/')
-    request.user = User.objects.filter(is_superuser=True).first()
-    view = ProjectExportView.as_view()
-    response = view(request, pk=project_id, format='xml')
-    return response.content.decode()
-
-
-def export_catalog(catalog_id):
-    if catalog_id not in catalogs:
-        catalog = Catalog.objects.get(id=catalog_id)
-        catalog.prefetch_elements()
-        serializer = CatalogExportSerializer(catalog)
-        xml = CatalogRenderer().render([serializer.data], context={
-            'sections': True,
-            'pages': True,
-            'questionsets': True,
-            'questions': True,
-            'attributes': True,
-            'optionsets': True,
-            'options': True,
-            'conditions': True
-        })
-        catalogs[catalog_id] = XMLResponse(xml, name='catalogs').content.decode()
-
-    return catalogs[catalog_id]
+        # Export complet (premier export ou option full) : tous les projets sont rendus, seuls les fichiers
+        # modifiés sont écrits et commités. Le listing de l'API (LISTE_FILE) n'est publié que dans ce cas
+        fetch_all_projects()
+        with exporter.count_queries('listing'), METRICS.timer('listing'):
+            projects = list(projects)
+        project_xmls = render_projects([project.id for project in projects], workers)
+        for project, project_xml in zip(projects, project_xmls):
+            project_path = base_path / str(project.id)
+            project_path.mkdir(exist_ok=True, parents=True)
+
+            project_xml_path = project_path / 'project.xml'
+            files = [project_xml_path] if write_if_changed(project_xml_path, project_xml) else []
+            files += write_catalog(project, project_path)
+            if files:
+                commit(project, project_path, files)
+
+    committer.shutdown(wait=True)
+    failures = sum(not future.result() for future in commits) + exporter.store_failures
+    if batch is not None:
+        batch.flush()
+        failures += batch.failures
+    finish_export(base_path, len(projects), options)
+    # le watermark n'avance que si tous les commits ont abouti : sinon le prochain export
+    # repart du même point et reprend les projets en échec
+    if failures:
+        print(f"[ERREUR] {failures} commit(s) en échec : watermark inchangé")
+        return
+    if only is None:
+        write_watermark(base_path, started)
+
+
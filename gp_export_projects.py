@@ -1,30 +1,71 @@
+import sys
+import traceback
 from pathlib import Path
 from datetime import datetime
-from git import Repo, Actor
-import hashlib
-import os
+from concurrent.futures import ThreadPoolExecutor
 
-from django.contrib.auth.models import User
-from django.test import RequestFactory
+from django.utils import timezone
 
-from rdmo.core.exports import XMLResponse
 from rdmo.projects.models import Project
-from rdmo.projects.views import ProjectExportView
-from rdmo.questions.models import Catalog
-from rdmo.questions.renderers import CatalogRenderer
-from rdmo.questions.serializers.export import CatalogExportSerializer
 
-# dict to cache the rendered catalogs
-catalogs = {}
+# fonctions communes aux scripts (rdmo_common.py, à côté de ce script dans rdmo-app/scripts) :
+# runscript importe ce script comme scripts.gp_export_projects, son dossier n'est pas dans sys.path
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from rdmo_common import (
+    CATALOG_POINTER, METRICS, MonorepoBatch, changed_catalogs, changed_projects, export_author,
+    export_catalog, finish_export, forget_blobs, git_commit, parse_options, read_watermark, record_export_commit,
+    refresh_catalog_store, render_projects, shared_catalog_pointer, start_export, write_if_changed, write_watermark,
+)
 
 
-def run(path):
+def run(path=None, *args):
     base_path = Path.cwd() / 'projects' if path is None else Path(path)
-    projects = Project.objects.all()
-
-    print(f"[INFO] Export de {projects.count()} projets vers {base_path}")
-
-    for project in projects:
+    options = parse_options(args)
+    exporter = start_export(base_path, options)
+    since = None if options.get('full') else read_watermark(base_path)
+    # projects=ID,ID... : seulement ces projets (ex. sur notification), sans toucher au watermark
+    only = [int(pid) for pid in str(options['projects']).split(',')] if options.get('projects') else None
+    started = timezone.now()
+    workers = int(options.get('workers', 1))
+    shared_catalogs = bool(options.get('shared_catalogs'))
+    fast_import_threshold = int(options.get('fast_import_threshold', 200))
+    # les dépôts des projets sont commités en parallèle pendant que la boucle continue
+    committer = ThreadPoolExecutor(max_workers=int(options.get('commit_workers', 4)))
+    batch = MonorepoBatch(base_path, int(options.get('batch', 500)), fast_import_threshold) if options.get('monorepo') else None
+    commits = []
+    # catalogues modifiés depuis le dernier export, calculé avant tout rendu de catalogue
+    refreshed_catalogs = changed_catalogs(base_path)
+
+    if only is not None:
+        projects = Project.objects.filter(id__in=only)
+        print(f"[INFO] Export des projets {', '.join(map(str, only))} vers {base_path}")
+    elif since is None:
+        projects = Project.objects.all()
+        print(f"[INFO] Export de {projects.count()} projets vers {base_path}")
+    else:
+        projects = changed_projects(since)
+        print(f"[INFO] Export de {projects.count()} projets modifiés depuis {since} vers {base_path}")
+
+    with exporter.count_queries('listing'), METRICS.timer('listing'):
+        projects = list(projects)
+        # projets inchangés dont le catalogue a changé depuis le dernier export : seuls leurs fichiers
+        # de catalogue sont rafraîchis, sans rendre leur project.xml. Avec shared_catalogs, leur pointeur
+        # ne change pas : seul le dépôt partagé des catalogues est mis à jour
+        catalog_projects = []
+        if since is not None and only is None and not shared_catalogs:
+            project_ids = {project.id for project in projects}
+            catalog_projects = [
+                project for project in Project.objects.filter(catalog_id__in=refreshed_catalogs)
+                if project.id not in project_ids
+            ]
+    if catalog_projects:
+        print(f"[INFO] {len(catalog_projects)} projets inchangés dont le catalogue a été modifié")
+    if since is not None and only is None and shared_catalogs:
+        with exporter.count_queries('catalog'):
+            refresh_catalog_store(base_path, refreshed_catalogs, batch)
+    project_xmls = render_projects([project.id for project in projects], workers)
+
+    for project, project_xml in [*zip(projects, project_xmls), *((project, None) for project in catalog_projects)]:
         print(f"\n[INFO] Traitement du projet {project.id} : {project.title}")
         project_path = base_path / str(project.id)
         project_path.mkdir(exist_ok=True, parents=True)
@@ -33,8 +74,9 @@ def run(path):
 
         # --- Project XML ---
         project_xml_path = project_path / 'project.xml'
-        project_xml = export_project(project.id)
-        if write_if_changed(project_xml_path, project_xml):
+        if project_xml is None:
+            print(f"[SKIP] project.xml non modifié depuis {since} pour {project.title}")
+        elif write_if_changed(project_xml_path, project_xml):
             print(f"[INFO] project.xml modifié pour {project.title}")
             files_to_commit.append(project_xml_path)
         else:
@@ -42,103 +84,93 @@ def run(path):
 
         # --- Catalog XML ---
         catalog_xml_path = project_path / 'catalog.xml'
-        catalog_xml = export_catalog(project.catalog.id)
-        if write_if_changed(catalog_xml_path, catalog_xml):
-            print(f"[INFO] catalog.xml modifié pour {project.title}")
-            files_to_commit.append(catalog_xml_path)
+        if shared_catalogs:
+            catalog_ref_path = project_path / CATALOG_POINTER
+            with exporter.count_queries('catalog'):
+                catalog_ref = shared_catalog_pointer(base_path, project.catalog_id, batch)
+            if write_if_changed(catalog_ref_path, catalog_ref):
+                print(f"[INFO] {CATALOG_POINTER} modifié pour {project.title}")
+                files_to_commit.append(catalog_ref_path)
+            if catalog_xml_path.exists():
+                # ancienne copie complète, remplacée par le pointeur
+                catalog_xml_path.unlink()
+                files_to_commit.append(catalog_xml_path)
         else:
-            print(f"[SKIP] catalog.xml inchangé pour {project.title}")
+            with exporter.count_queries('catalog'):
+                catalog_xml = export_catalog(project.catalog_id)
+            if write_if_changed(catalog_xml_path, catalog_xml):
+                print(f"[INFO] catalog.xml modifié pour {project.title}")
+                files_to_commit.append(catalog_xml_path)
+            else:
+                print(f"[SKIP] catalog.xml inchangé pour {project.title}")
 
         # --- Commit si des fichiers ont changé ---
-        if files_to_commit:
-            git_commit_project(project_path, files_to_commit, project)
+        if files_to_commit and batch is not None:
+            batch.add(f"{project.id} ({project.title})", files_to_commit, project_date(project), project)
+        elif files_to_commit:
+            commits.append(committer.submit(git_commit_project, project_path, files_to_commit, project))
         else:
             print(f"[INFO] Aucun changement détecté pour {project.title}, pas de commit.")
 
-
-def export_project(project_id):
-    factory = RequestFactory()
-    request = factory.get('/dummy-url/')
-    request.user = User.objects.filter(is_superuser=True).first()
-    view = ProjectExportView.as_view()
-    response = view(request, pk=project_id, format='xml')
-    return response.content.decode()
-
-
-def export_catalog(catalog_id):
-    if catalog_id not in catalogs:
-        catalog = Catalog.objects.get(id=catalog_id)
-        catalog.prefetch_elements()
-        serializer = CatalogExportSerializer(catalog)
-        xml = CatalogRenderer().render([serializer.data], context={
-            'sections': True,
-            'pages': True,
-            'questionsets': True,
-            'questions': True,
-            'attributes': True,
-            'optionsets': True,
-            'options': True,
-            'conditions': True
-        })
-        catalogs[catalog_id] = XMLResponse(xml, name='catalogs').content.decode()
-
-    return catalogs[catalog_id]
-
-
-def write_if_changed(path: Path, new_content: str) -> bool:
-    """Écrit le fichier seulement si le contenu a changé. Retourne True si modifié."""
-    new_hash = hashlib.md5(new_content.encode("utf-8")).hexdigest()
-    if path.exists():
-        old_hash = hashlib.md5(path.read_bytes()).hexdigest()
-        if old_hash == new_hash:
-            return False  # Pas de changement
-
-    with path.open('w', encoding='utf-8') as f:
-        f.write(new_content)
-    return True
+    committer.shutdown(wait=True)
+    failures = sum(not future.result() for future in commits) + exporter.store_failures
+    if batch is not None:
+        batch.flush()
+        failures += batch.failures
+    finish_export(base_path, len(projects), options)
+    # le watermark n'avance que si tous les commits ont abouti : sinon le prochain export
+    # reprend les projets en échec
+    if failures:
+        print(f"[ERREUR] {failures} commit(s) en échec : watermark inchangé")
+        return
+    if only is None:
+        write_watermark(base_path, started)
+
+
+def project_date(project):
+    """Date de dernière modification RDMO du projet, utilisée comme date des commits."""
+    last_mod = getattr(project, "last_modified", None) or datetime.now().astimezone()
+
+    # Conversion si c’est une chaîne ISO
+    if isinstance(last_mod, str):
+        try:
+            last_mod = datetime.fromisoformat(last_mod)
+        except ValueError:
+            try:
+                from dateutil import parser
+                last_mod = parser.parse(last_mod)
+            except Exception:
+                last_mod = datetime.now()
+    # GitPython refuse les dates sans fuseau horaire
+    return last_mod if last_mod.tzinfo else last_mod.astimezone()
 
 
 def git_commit_project(project_path: Path, files, project):
-    """Initialise un repo git dans le dossier du projet et commit tous les fichiers modifiés en un seul commit"""
+    """Commit tous les fichiers modifiés du projet en un seul commit, dans le dépôt git du dossier du projet
+    (initialisé si besoin), daté de la dernière modification RDMO.
+    Pas d'os.chdir : plusieurs projets peuvent être commités depuis des threads. Retourne False si le commit a échoué."""
     if not (project_path / ".git").exists():
-        repo = Repo.init(project_path)
         print(f"[GIT] Nouveau dépôt initialisé dans {project_path}")
-    else:
-        repo = Repo(project_path)
 
-    original_dir = Path.cwd()
-    try:
-        os.chdir(project_path)
-
-        repo.index.add([f.name for f in files])
-
-        # Récupération de la date de dernière modification RDMO
-        last_mod = getattr(project, "last_modified", None) or datetime.now()
-
-        # Conversion si c’est une chaîne ISO
-        if isinstance(last_mod, str):
-            try:
-                last_mod = datetime.fromisoformat(last_mod)
-            except ValueError:
-                try:
-                    from dateutil import parser
-                    last_mod = parser.parse(last_mod)
-                except Exception:
-                    last_mod = datetime.now()
+    # Récupération de la date de dernière modification RDMO
+    last_mod = project_date(project)
+    commit_msg = f"Update project {project.id} ({project.title}) on {last_mod.strftime('%Y-%m-%d %H:%M:%S')}"
+    # les fichiers supprimés (catalog.xml remplacé par un pointeur) sont retirés du dépôt
+    changes = {f.name: f.read_bytes() if f.exists() else None for f in files}
 
+    try:
         print(f"[GIT] Commit en préparation pour {project.title} ({project.id})")
         print(f"       - Fichiers : {[f.name for f in files]}")
         print(f"       - Date utilisée : {last_mod} (type={type(last_mod)})")
         print(f"       - Repo : {project_path}")
 
-        commit_msg = f"Update project {project.id} ({project.title}) on {last_mod.strftime('%Y-%m-%d %H:%M:%S')}"
-
         # Utiliser la date RDMO comme date du commit git
-        author = Actor("RDMO Export", "rdmo@example.com")
-        repo.index.commit(
+        sha = git_commit(
+            project_path,
+            changes,
             commit_msg,
-            author=author,
-            committer=author,
+            author=export_author(),
+            committer=export_author(),
             author_date=last_mod,
             commit_date=last_mod,
         )
@@ -146,5 +178,8 @@ def git_commit_project(project_path: Path, files, project):
         print(f"[GIT] ✅ Commit effectué pour {project.title} ({project.id}) à {last_mod}")
     except Exception as e:
         print(f"[ERREUR] Git add/commit a échoué pour {project.title} : {e}")
-    finally:
-        os.chdir(original_dir)
+        traceback.print_exc()
+        forget_blobs(files)
+        return False
+    record_export_commit(project_path, sha, [(project, files)])
+    return True
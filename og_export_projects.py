@@ -1,26 +1,33 @@
 '''
-Put in `/path/to/rdmo-app/scripts/export_projects.py`.
+Put in `/path/to/rdmo-app/scripts/export_projects.py`, together with `rdmo_common.py` (shared helpers).
 Call with `./manage.py runscript export_projects --script-args ~/rdmo_exports`.
+Add `workers=N` to render the project XML on N processes.
+The XML is written in canonical form (sorted values, no export/save timestamps) so that unchanged projects produce no diff.
+Rendered catalogs are cached in `<path>/.catalog_cache` across runs (`catalog_cache=DIR`, `catalog_cache_mb=N`).
+Per-phase timings (listing, render, catalog_render) are printed at the end; `metrics_json=FILE` and `metrics_prom=FILE`
+also save them as a JSON report and a Prometheus textfile.
 '''
 
+import sys
 from pathlib import Path
 
-from django.contrib.auth.models import User
-from django.test import RequestFactory
-
-from rdmo.core.exports import XMLResponse
 from rdmo.projects.models import Project
-from rdmo.projects.views import ProjectExportView
-from rdmo.questions.models import Catalog
-from rdmo.questions.renderers import CatalogRenderer
-from rdmo.questions.serializers.export import CatalogExportSerializer
 
-# dict to cache the rendered catalogs
-catalogs = {}
+# fonctions communes aux scripts (rdmo_common.py, à côté de ce script dans rdmo-app/scripts) :
+# runscript importe ce script comme scripts.og_export_projects, son dossier n'est pas dans sys.path
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from rdmo_common import METRICS, export_catalog, finish_export, parse_options, render_projects, start_export
+
 
-def run(path):
+def run(path=None, *args):
     base_path = Path.cwd() / 'projects' if path is None else Path(path)
-    projects = Project.objects.all()
+    options = parse_options(args)
+    exporter = start_export(base_path, options)
+    with exporter.count_queries('listing'), METRICS.timer('listing'):
+        projects = list(Project.objects.all())
+
+    missing = [project.id for project in projects if not (base_path / str(project.id) / 'project.xml').exists()]
+    project_xmls = render_projects(missing, int(options.get('workers', 1)))
 
     for project in projects:
         project_path = base_path / str(project.id)
@@ -28,41 +35,17 @@ def run(path):
 
         project_xml_path = project_path / 'project.xml'
         if not project_xml_path.exists():
-            project_xml = export_project(project.id)
+            project_xml = next(project_xmls)
             with project_xml_path.open('w') as fp:
                 fp.write(project_xml)
 
         catalog_xml_path = project_path / 'catalog.xml'
         if not catalog_xml_path.exists():
-            catalog_xml = export_catalog(project.catalog.id)
+            with exporter.count_queries('catalog'):
+                catalog_xml = export_catalog(project.catalog_id)
             with catalog_xml_path.open('w') as fp:
                 fp.write(catalog_xml)
 
+    finish_export(base_path, len(projects), options)
 
-def export_project(project_id):
-    factory = RequestFactory()
-    request = factory.get('/dummy-url/')
-    request.user = User.objects.filter(is_superuser=True).first()
-    view = ProjectExportView.as_view()
-    response = view(request, pk=project_id, format='xml')
-    return response.content.decode()
-
-
-def export_catalog(catalog_id):
-    if catalog_id not in catalogs:
-        catalog = Catalog.objects.get(id=catalog_id)
-        catalog.prefetch_elements()
-        serializer = CatalogExportSerializer(catalog)
-        xml = CatalogRenderer().render([serializer.data], context={
-            'sections': True,
-            'pages': True,
-            'questionsets': True,
-            'questions': True,
-            'attributes': True,
-            'optionsets': True,
-            'options': True,
-            'conditions': True
-        })
-        catalogs[catalog_id] = XMLResponse(xml, name='catalogs').content.decode()
 
-    return catalogs[catalog_id]
@@ -0,0 +1,1099 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+'''
+Fonctions communes aux scripts RDMO : sync_rdmo_projects.py (API) et export_projects.py,
+gp_export_projects.py, og_export_projects.py (runscript, par l'ORM).
+Put in `/path/to/rdmo-app/scripts/rdmo_common.py`, next to the scripts that import it.
+Métriques, commits git sans os.chdir, fast-import et index des commits sont utilisés par tous les scripts,
+les appels à l'API (session, limitation de débit, listing) par sync_rdmo_projects.py et export_projects.py ; la partie export
+(contexte, rendu et cache des catalogues, index des blobs, monorepo) seulement par les scripts runscript.
+requests, GitPython et Django sont importés dans les fonctions qui s'en servent : sync_rdmo_projects.py importe
+ce module sans Django, et ses commandes sans git (`status`, `--help`) n'ont pas à charger GitPython.
+'''
+import os
+import json
+import math
+import random
+import hashlib
+import sqlite3
+import subprocess
+import multiprocessing
+import traceback
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from io import BytesIO, StringIO
+from itertools import islice
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from time import monotonic, sleep, perf_counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from contextlib import contextmanager
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+##########################################################################################################################################################################################################################################################################################
+####   Métriques
+##########################################################################################################################################################################################################################################################################################
+
+class Metrics:
+    """Compteurs et histogrammes de durée par phase (listing, téléchargement, hash, rendu, commit...),
+    exportés en rapport JSON et au format textfile de Prometheus (collecteur textfile de node_exporter)."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = perf_counter()
+        self.counters = Counter()
+        self.phases = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            stats = self.phases.setdefault(phase, {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(self.BUCKETS)})
+            stats["count"] += 1
+            stats["sum"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+
+    @contextmanager
+    def timer(self, phase):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, perf_counter() - started)
+
+    def report(self):
+        """Rapport du run, sérialisable en JSON (buckets cumulés, comme dans Prometheus)."""
+        with self.lock:
+            return {
+                "duration": perf_counter() - self.started,
+                "counters": dict(sorted(self.counters.items())),
+                "buckets": list(self.BUCKETS),
+                "phases": {
+                    phase: dict(stats, buckets=list(stats["buckets"]), mean=stats["sum"] / stats["count"])
+                    for phase, stats in sorted(self.phases.items())
+                },
+            }
+
+    def print_summary(self):
+        report = self.report()
+        for phase, stats in report["phases"].items():
+            print(f"[RÉSUMÉ] {phase} : {stats['count']} fois, {stats['sum']:.2f} s au total, "
+                  f"moyenne {stats['mean'] * 1000:.1f} ms, max {stats['max'] * 1000:.1f} ms")
+
+    def write_json(self, path):
+        write_atomic(Path(path), json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path, prefix):
+        """Fichier .prom pour le collecteur textfile : écrit puis renommé, jamais lu à moitié."""
+        report = self.report()
+        lines = [
+            f"# HELP {prefix}_run_duration_seconds Durée du run (ou depuis le démarrage du démon).",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration']:.3f}",
+        ]
+        for name, value in report["counters"].items():
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        lines += [
+            f"# HELP {prefix}_phase_duration_seconds Durée de chaque opération, par phase.",
+            f"# TYPE {prefix}_phase_duration_seconds histogram",
+        ]
+        for phase, stats in report["phases"].items():
+            for bound, count in zip(self.BUCKETS, stats["buckets"]):
+                lines.append(f'{prefix}_phase_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+            lines += [
+                f'{prefix}_phase_duration_seconds_bucket{{phase="{phase}",le="+Inf"}} {stats["count"]}',
+                f'{prefix}_phase_duration_seconds_sum{{phase="{phase}"}} {stats["sum"]:.6f}',
+                f'{prefix}_phase_duration_seconds_count{{phase="{phase}"}} {stats["count"]}',
+            ]
+        write_atomic(Path(path), "\n".join(lines) + "\n")
+
+
+def write_atomic(path: Path, text):
+    """Écrit text dans path via un fichier temporaire renommé."""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
+
+
+class CommitStats:
+    """Débit des commits git sur un run : nombre de commits, temps passé dans git (cumulé sur
+    les threads) et temps écoulé. Le rapport cumulé / écoulé mesure le gain des commits parallèles."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.busy = 0.0
+        self.started = perf_counter()
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.busy += seconds
+
+    def report(self):
+        elapsed = perf_counter() - self.started
+        if self.count:
+            print(f"[RÉSUMÉ] {self.count} commit(s) git en {elapsed:.1f} s ({self.count / elapsed:.1f} commits/s), "
+                  f"temps git cumulé {self.busy:.1f} s, parallélisme x{self.busy / elapsed:.1f}")
+
+
+COMMIT_STATS = CommitStats()
+
+
+##########################################################################################################################################################################################################################################################################################
+####   Commits git
+##########################################################################################################################################################################################################################################################################################
+
+# verrous git par dépôt, voir repo_lock
+_repo_locks = {}
+_repo_locks_guard = Lock()
+
+
+def repo_lock(repo_path: Path):
+    """Verrou propre au dépôt repo_path : les commits d'un même dépôt sont sérialisés,
+    ceux de dépôts différents peuvent se faire en parallèle depuis des threads."""
+    key = str(Path(repo_path).resolve())
+    with _repo_locks_guard:
+        return _repo_locks.setdefault(key, Lock())
+
+
+def git_commit(repo_path: Path, files, message, **commit_args):
+    """Commit files {chemin relatif au dépôt: contenu (bytes) ou None pour le supprimer} dans le dépôt
+    repo_path, initialisé si besoin. Les blobs sont écrits directement dans la base d'objets :
+    index.add avec des chemins fait un os.chdir (global au processus), pas ici, ce qui permet de
+    commiter plusieurs dépôts en parallèle. commit_args est passé à index.commit. Retourne le sha."""
+    from git import Repo, Blob, BaseIndexEntry
+    from gitdb import IStream
+    started = perf_counter()
+    with repo_lock(repo_path):
+        with Repo(repo_path) if (repo_path / ".git").exists() else Repo.init(repo_path) as repo:
+            index = repo.index
+            removed = [path for path, content in files.items() if content is None]
+            if removed:
+                index.remove(removed, working_tree=False, ignore_unmatch=True)
+            entries = []
+            for path, content in files.items():
+                if content is not None:
+                    blob = repo.odb.store(IStream(Blob.type, len(content), BytesIO(content)))
+                    entries.append(BaseIndexEntry((Blob.file_mode, blob.binsha, 0, path)))
+            index.add(entries)
+            commit_sha = index.commit(message, **commit_args).hexsha
+    elapsed = perf_counter() - started
+    COMMIT_STATS.record(elapsed)
+    METRICS.observe("git_commit", elapsed)
+    return commit_sha
+
+
+def fast_import(repo_path: Path, commits):
+    """Écrit des commits avec `git fast-import` : les objets vont directement dans un pack, sans passer
+    par l'index ni créer d'objets isolés, ce qui est bien plus rapide pour un gros lot du monorepo.
+    Pas pour un commit isolé : lancer git fast-import et git reset par dépôt ne gagne rien sur l'index.
+    commits : liste de dicts {files: {chemin relatif: contenu (bytes) ou None pour le supprimer},
+    message, author, committer (Actor), date (datetime)}. L'arborescence, les auteurs et les dates sont
+    les mêmes qu'avec repo.index.commit ; l'index est resynchronisé à la fin. Retourne le sha du dernier commit."""
+    from git import Repo
+    started = perf_counter()
+    with repo_lock(repo_path):
+        with Repo(repo_path) if (repo_path / ".git").exists() else Repo.init(repo_path) as repo:
+            branch = repo.head.ref.path
+            has_parent = repo.head.is_valid()
+
+            process = subprocess.Popen(["git", "-C", str(repo_path), "fast-import", "--quiet", "--done"], stdin=subprocess.PIPE)
+            write = process.stdin.write
+            try:
+                for i, commit in enumerate(commits):
+                    date = commit["date"] if commit["date"].tzinfo else commit["date"].astimezone()
+                    offset = int(date.utcoffset().total_seconds() // 60)
+                    when = f"{int(date.timestamp())} {'-' if offset < 0 else '+'}{abs(offset) // 60:02d}{abs(offset) % 60:02d}"
+                    message = commit["message"].encode("utf-8")
+                    write(f"commit {branch}\n".encode("utf-8"))
+                    write(f"author {commit['author'].name} <{commit['author'].email}> {when}\n".encode("utf-8"))
+                    write(f"committer {commit['committer'].name} <{commit['committer'].email}> {when}\n".encode("utf-8"))
+                    write(b"data %d\n%s\n" % (len(message), message))
+                    if i == 0 and has_parent:
+                        write(f"from {branch}^0\n".encode("utf-8"))
+                    for path, content in commit["files"].items():
+                        quoted = '"' + path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                        if content is None:
+                            write(f"D {quoted}\n".encode("utf-8"))
+                        else:
+                            write(f"M 100644 inline {quoted}\n".encode("utf-8"))
+                            write(b"data %d\n%s\n" % (len(content), content))
+                    write(b"\n")
+                write(b"done\n")
+            finally:
+                process.stdin.close()
+                returncode = process.wait()
+            if returncode != 0:
+                raise Exception(f"git fast-import a échoué ({returncode}) dans {repo_path}")
+
+            # l'index ne connaît pas encore les nouveaux commits
+            repo.git.reset("--quiet")
+            commit_sha = repo.head.commit.hexsha
+    elapsed = perf_counter() - started
+    COMMIT_STATS.record(elapsed)
+    METRICS.observe("fast_import", elapsed)
+    return commit_sha
+
+
+def git_blob_sha(data: bytes) -> str:
+    """Identifiant git (blob) d'un contenu, tel que `git hash-object` le calcule.
+    L'en-tête et le contenu sont passés séparément au hash, sans copie du contenu."""
+    sha = hashlib.sha1(b'blob %d\0' % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+
+def head_blob_sha(path: Path):
+    """Blob du fichier dans le commit HEAD du dépôt git qui le contient, None s'il n'est pas versionné."""
+    from git import Repo
+    for root in path.parents:
+        if (root / '.git').exists():
+            try:
+                with Repo(root) as repo:
+                    return repo.head.commit.tree[path.relative_to(root).as_posix()].hexsha
+            except (ValueError, KeyError):
+                return None
+    return None
+
+
+##########################################################################################################################################################################################################################################################################################
+####   Index des commits
+##########################################################################################################################################################################################################################################################################################
+
+# Index SQLite des commits (projet, sha, date RDMO, fichiers, hash du contenu) à la racine des dépôts : rempli par
+# la synchronisation et les exports au fil des commits, complété depuis les dépôts par `reindex` de
+# sync_rdmo_projects.py, interrogé par sa commande `history`.
+HISTORY_DB = ".history.sqlite3"
+_history_lock = Lock()
+
+
+def history_time(value):
+    """Date (ISO 8601 ou datetime) -> chaîne UTC de l'index, comparable comme texte."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    return value.astimezone(timezone.utc).isoformat(timespec="seconds")
+
+
+def open_history(root: Path):
+    """Ouvre (et crée si besoin) l'index des commits HISTORY_DB de root.
+    commits : un enregistrement par projet et par commit ; repos : dernier commit indexé de chaque dépôt."""
+    history = sqlite3.connect(root / HISTORY_DB, check_same_thread=False)
+    history.row_factory = sqlite3.Row
+    history.execute("PRAGMA journal_mode=WAL")
+    history.executescript("""
+        CREATE TABLE IF NOT EXISTS commits (
+            project_id INTEGER NOT NULL,
+            commit_sha TEXT NOT NULL,
+            changed_at TEXT NOT NULL,
+            files TEXT NOT NULL,
+            content_hash TEXT,
+            PRIMARY KEY (project_id, commit_sha)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS commits_changed_at ON commits (changed_at);
+        CREATE INDEX IF NOT EXISTS commits_project ON commits (project_id, changed_at);
+        CREATE TABLE IF NOT EXISTS repos (path TEXT PRIMARY KEY, head TEXT NOT NULL) WITHOUT ROWID;
+    """)
+    return history
+
+
+def record_commit(history, repo_path: Path, commit_sha, entries):
+    """Ajoute un commit à l'index dès qu'il est fait. entries : [(id du projet, date RDMO, fichiers, hash du contenu)],
+    la date enregistrée est celle de RDMO (pas la date du commit). Appelable depuis les threads de commit."""
+    with _history_lock, history:
+        history.executemany("INSERT OR IGNORE INTO commits VALUES (?, ?, ?, ?, ?)", (
+            (project_id, commit_sha, history_time(date),
+             "\n".join(path.relative_to(repo_path).as_posix() for path in files), content_hash)
+            for project_id, date, files, content_hash in entries
+        ))
+
+
+##########################################################################################################################################################################################################################################################################################
+####   API REST de RDMO
+##########################################################################################################################################################################################################################################################################################
+
+# jeton et adresse de l'API : TOKENRDMO et MYRDMO (export_projects.py lit aussi les anciens noms tokenrdmo et myrdmo).
+# Lus à l'import mais obligatoires seulement pour les appels à l'API
+TOKEN = os.environ.get("TOKENRDMO") or os.environ.get("tokenrdmo", "")
+MYRDMO = os.environ.get("MYRDMO") or os.environ.get("myrdmo", "")
+LISTE_PROJET_URL = f"{MYRDMO}/api/v1/projects/projects/"
+
+# Paramètres de la session HTTP partagée (pool keep-alive)
+HTTP_POOL_SIZE = int(os.environ.get("RDMO_HTTP_POOL_SIZE", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("RDMO_HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.environ.get("RDMO_HTTP_READ_TIMEOUT", "300"))
+HTTP_CHUNK_SIZE = 64 * 1024
+
+# Limitation de débit et reprises sur erreur pour tous les appels API
+HTTP_RATE = float(os.environ.get("RDMO_RATE", "5"))                  # req/s au démarrage
+HTTP_RATE_MIN = float(os.environ.get("RDMO_RATE_MIN", "0.5"))
+HTTP_RATE_MAX = float(os.environ.get("RDMO_RATE_MAX", "50"))
+HTTP_TARGET_LATENCY = float(os.environ.get("RDMO_TARGET_LATENCY", "2"))  # secondes
+HTTP_RETRIES = int(os.environ.get("RDMO_HTTP_RETRIES", "5"))
+HTTP_BACKOFF_BASE = float(os.environ.get("RDMO_BACKOFF_BASE", "1"))
+HTTP_BACKOFF_MAX = float(os.environ.get("RDMO_BACKOFF_MAX", "60"))
+HTTP_RETRY_CODES = {429, 500, 502, 503, 504}
+
+_session = None
+
+# Nombre de pages du listing récupérées en parallèle
+LIST_WORKERS = int(os.environ.get("RDMO_LIST_WORKERS", "4"))
+LISTING_HEADER = '{"results": ['
+
+
+class RateLimiter:
+    """Budget de requêtes (token bucket) partagé par tous les appels API.
+
+    Le débit s'ajuste tout seul : il augmente doucement tant que le serveur répond vite,
+    et il est divisé par deux sur 429/5xx ou erreur réseau (AIMD), au plus une fois par fenêtre
+    (la latence lissée, une seconde au moins) : une rafale d'erreurs des workers en vol ne compte qu'une fois.
+    Un Retry-After met tous les workers en pause jusqu'à l'échéance."""
+
+    def __init__(self, rate, min_rate, max_rate, target_latency):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.latency = None
+        self.tokens = 1.0
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = float("-inf")
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    burst = max(1.0, self.rate)
+                    self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if self.latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def record_error(self, retry_after=None):
+        with self.lock:
+            now = monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if now - self.last_decrease < max(1.0, self.latency or 0.0):
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            print(f"[RATE] Débit réduit à {self.rate:.2f} req/s")
+
+
+RATE_LIMITER = RateLimiter(HTTP_RATE, HTTP_RATE_MIN, HTTP_RATE_MAX, HTTP_TARGET_LATENCY)
+
+
+def parse_retry_after(value):
+    """Retry-After en secondes, qu'il soit donné en secondes ou en date HTTP."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt):
+    """Attente exponentielle avec jitter complet avant la tentative attempt + 1."""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def get_session():
+    """Retourne la session HTTP partagée (pool de connexions keep-alive) utilisée pour tous les appels API."""
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.headers.update({"Authorization": f"Token {TOKEN}"})
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session = session
+    return _session
+
+
+def api_get(url, stream=False):
+    """GET sur l'API RDMO via la session partagée et le RATE_LIMITER.
+    Les 429/5xx et erreurs réseau sont retentés avec backoff, en respectant Retry-After.
+    Lève une exception si le code HTTP n'est toujours pas 200."""
+    import requests
+    for attempt in range(HTTP_RETRIES + 1):
+        RATE_LIMITER.acquire()
+        METRICS.inc("http_requests")
+        start = monotonic()
+        try:
+            response = get_session().get(url, stream=stream, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            RATE_LIMITER.record_error()
+            if attempt == HTTP_RETRIES:
+                print(f"[ERREUR] Requête échouée pour {url} : {e}")
+                raise
+            delay = backoff_delay(attempt)
+            METRICS.inc("http_retries")
+            print(f"[RETRY] {url} : {e}, nouvelle tentative dans {delay:.1f}s ({attempt + 1}/{HTTP_RETRIES})")
+            sleep(delay)
+            continue
+        except requests.RequestException as e:
+            print(f"[ERREUR] Requête échouée pour {url} : {e}")
+            raise
+
+        if response.status_code == 200:
+            RATE_LIMITER.record_success(monotonic() - start)
+            return response
+
+        if response.status_code in HTTP_RETRY_CODES and attempt < HTTP_RETRIES:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            RATE_LIMITER.record_error(retry_after)
+            response.close()
+            delay = max(retry_after or 0, backoff_delay(attempt))
+            METRICS.inc("http_retries")
+            print(f"[RETRY] Code HTTP {response.status_code} pour {url}, nouvelle tentative dans {delay:.1f}s ({attempt + 1}/{HTTP_RETRIES})")
+            sleep(delay)
+            continue
+
+        METRICS.inc("http_errors")
+        print(f"[ERREUR] Code HTTP {response.status_code} pour {url}")
+        print(f"[DEBUG] Réponse : {response.text[:500]}...")  # Tronque pour pas spammer
+        response.close()
+        raise Exception(f"Échec HTTP {response.status_code}")
+
+
+def page_url(url, page):
+    """Remplace (ou ajoute) le paramètre page dans url."""
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key != "page"]
+    query.append(("page", str(page)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def iter_remote_projects(url=LISTE_PROJET_URL):
+    """Itère sur les projets de l'API au fil de l'eau.
+    count et la taille de page sont lus sur la première page ; si le lien next porte un paramètre page,
+    les pages suivantes sont récupérées en parallèle (LIST_WORKERS) dans une fenêtre bornée."""
+    print(f"[INFO] Téléchargement de {url}")
+    with METRICS.timer("listing_page"):
+        first = api_get(url).json()
+    results = first.get("results", [])
+    yield from results
+
+    if not first.get("next"):
+        return
+    if "count" not in first or not results or "page" not in dict(parse_qsl(urlsplit(first["next"]).query)):
+        # pas de count exploitable, ou pagination sans numéro de page (limit/offset...) :
+        # on suit les liens next un par un
+        next_url = first["next"]
+        while next_url:
+            print(f"[INFO] Téléchargement de {next_url}")
+            with METRICS.timer("listing_page"):
+                data = api_get(next_url).json()
+            yield from data.get("results", [])
+            next_url = data.get("next")
+        return
+
+    page_count = math.ceil(first["count"] / len(results))
+    print(f"[INFO] {first['count']} projets sur {page_count} pages")
+
+    def fetch_page(page):
+        with METRICS.timer("listing_page"):
+            return api_get(page_url(first["next"], page)).json().get("results", [])
+
+    pages = iter(range(2, page_count + 1))
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        pending = {executor.submit(fetch_page, page) for page in islice(pages, 2 * LIST_WORKERS)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+                pending.update(executor.submit(fetch_page, page) for page in islice(pages, 1))
+
+
+def safe_title(title):
+    return title.replace(" ", "_").replace("/", "-")
+
+
+def iter_listing(filename):
+    """Lit un ancien fichier de listing projet par projet (utilisé pour reprendre old_liste_projet.json)."""
+    with open(filename, "r", encoding="utf-8") as f:
+        if f.readline().strip() != LISTING_HEADER:
+            f.seek(0)
+            yield from json.load(f)["results"]
+            return
+        for line in f:
+            line = line.strip().rstrip(",")
+            if line and line != "]}":
+                yield json.loads(line)
+
+
+##########################################################################################################################################################################################################################################################################################
+####   Export par l'ORM (runscript)
+##########################################################################################################################################################################################################################################################################################
+
+# dict to cache the rendered catalogs
+catalogs = {}
+
+# contexte d'export (superuser, requête, vue), créé au début du run et hérité par les workers
+exporter = None
+
+# cache disque des catalogues rendus (option catalog_cache=CHEMIN, taille max catalog_cache_mb=N)
+catalog_cache = None
+
+# forme canonique des XML écrits : champs qui changent à chaque export sans que les réponses changent
+# (date d'export sur la racine, dates d'enregistrement), et ordre des valeurs d'un projet
+VOLATILE_FIELDS = ('created', 'updated')
+VALUE_ORDER = ('attribute', 'set_prefix', 'set_index', 'collection_index')
+
+# stockage partagé des catalogues (option shared_catalogs) : chaque version est écrite une seule fois
+# dans base_path/catalogs, les projets n'ont qu'un petit fichier pointeur catalog.ref, qui ne change pas
+# avec la version du catalogue
+CATALOG_STORE = 'catalogs'
+CATALOG_POINTER = 'catalog.ref'
+EXPORT_AUTHOR = ("RDMO Export", "rdmo@example.com")
+catalog_pointers = {}
+
+# date du dernier export réussi, pour ne traiter que les projets modifiés depuis
+WATERMARK_FILE = '.export_watermark'
+
+# empreinte des catalogues au début du dernier export réussi, écrite avec le watermark (catalogue -> empreinte)
+CATALOGS_FILE = '.export_catalogs'
+catalog_fingerprints = {}
+
+# blob git de chaque fichier écrit par l'export, pour détecter les changements sans relire les fichiers
+BLOB_INDEX_FILE = '.export_blobs'
+blob_index = None
+
+# index des commits (HISTORY_DB) de base_path, ouvert pendant le run
+history = None
+
+
+def start_export(base_path: Path, options):
+    """Début d'un run d'export : contexte (superuser, requête, vue), cache disque des catalogues,
+    index des blobs, index des commits et métriques remis à zéro. Retourne le contexte."""
+    global exporter, catalog_cache, blob_index, history
+    exporter = ExportContext()
+    catalog_pointers.clear()
+    catalog_fingerprints.clear()
+    COMMIT_STATS.reset()
+    METRICS.reset()
+    catalog_cache = CatalogCache(
+        options.get('catalog_cache', base_path / '.catalog_cache'),
+        int(options.get('catalog_cache_mb', 500)) * 1024 * 1024
+    )
+    blob_index = BlobIndex(base_path)
+    base_path.mkdir(exist_ok=True, parents=True)
+    history = open_history(base_path)
+    return exporter
+
+
+def finish_export(base_path: Path, project_count, options):
+    """Fin d'un run d'export : requêtes SQL, commits et métriques (metrics_json=FICHIER, metrics_prom=FICHIER),
+    puis sauvegarde de l'index des blobs et fermeture de l'index des commits."""
+    exporter.report(project_count)
+    COMMIT_STATS.report()
+    METRICS.print_summary()
+    if options.get('metrics_json'):
+        METRICS.write_json(options['metrics_json'])
+    if options.get('metrics_prom'):
+        METRICS.write_prometheus(options['metrics_prom'], 'rdmo_export')
+    blob_index.save()
+    history.close()
+
+
+def export_author():
+    """Auteur et committer des commits de l'export."""
+    from git import Actor
+    return Actor(*EXPORT_AUTHOR)
+
+
+def record_export_commit(repo_path: Path, commit_sha, projects):
+    """Ajoute un commit de l'export à l'index des commits. projects : [(projet RDMO, fichiers commités)] ;
+    la date enregistrée est project.updated, le hash est le blob git du project.xml du projet."""
+    record_commit(history, repo_path, commit_sha, [
+        (project.id, project.updated, files, blob_index.get(files[0].parent / 'project.xml'))
+        for project, files in projects
+    ])
+
+
+def forget_blobs(files):
+    """Commit en échec : les fichiers sont oubliés de l'index des blobs, ils seront réécrits et commités au prochain export."""
+    for f in files:
+        blob_index.forget(f)
+
+
+def parse_options(args):
+    """Options passées après le chemin dans --script-args : `cle=valeur` ou drapeau seul (ex. `full`)."""
+    options = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        options[key] = value if value else True
+    return options
+
+
+def read_watermark(base_path: Path):
+    """Date du début du dernier export réussi, ou None (premier export ou export complet)."""
+    watermark_path = base_path / WATERMARK_FILE
+    if not watermark_path.exists():
+        return None
+    return datetime.fromisoformat(watermark_path.read_text().strip())
+
+
+def write_watermark(base_path: Path, started):
+    """Enregistre la date de début de l'export réussi, et les empreintes des catalogues relevées
+    par changed_catalogs au même moment."""
+    write_atomic(base_path / CATALOGS_FILE, json.dumps(catalog_fingerprints, sort_keys=True))
+    (base_path / WATERMARK_FILE).write_text(started.isoformat())
+
+
+def changed_projects(since):
+    """Projets dont le projet lui-même ou une de ses valeurs a été modifié depuis since, filtrés par la base."""
+    from django.db.models import Max
+    from django.db.models.functions import Coalesce, Greatest
+    from rdmo.projects.models import Project
+    return Project.objects.annotate(
+        changed=Greatest('updated', Coalesce(Max('values__updated'), 'updated'))
+    ).filter(changed__gte=since)
+
+
+def changed_catalogs(base_path: Path):
+    """Catalogues modifiés depuis le dernier export réussi : leur empreinte (date du catalogue, état des
+    éléments partagés, version de RDMO) diffère de celle enregistrée avec le watermark. Les empreintes
+    relevées ici sont celles que write_watermark enregistrera : à appeler au début du run, avant tout rendu."""
+    from rdmo.questions.models import Catalog
+    try:
+        exported = json.loads((base_path / CATALOGS_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        exported = {}
+    catalog_fingerprints.clear()
+    for catalog_id in Catalog.objects.values_list('id', flat=True):
+        catalog_fingerprints[str(catalog_id)] = catalog_cache.fingerprint(catalog_id)
+    return {
+        int(catalog_id) for catalog_id, fingerprint in catalog_fingerprints.items()
+        if exported.get(catalog_id) != fingerprint
+    }
+
+
+class ExportContext:
+    """Contexte partagé par tout un export : le superuser, la requête et la vue sont résolus une seule fois.
+    Compte aussi les requêtes SQL par phase, pour vérifier qu'un gros export en émet un nombre borné,
+    et les commits en échec du dépôt partagé des catalogues."""
+
+    def __init__(self):
+        from django.contrib.auth.models import User
+        from django.test import RequestFactory
+        from rdmo.projects.views import ProjectExportView
+        self.queries = Counter()
+        self.store_failures = 0
+        with self.count_queries('setup'):
+            self.request = RequestFactory().get('/dummy-url/')
+            self.request.user = User.objects.filter(is_superuser=True).first()
+        self.view = ProjectExportView.as_view()
+
+    @contextmanager
+    def count_queries(self, phase):
+        from django.db import connection
+
+        def wrapper(execute, sql, params, many, context):
+            self.queries[phase] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            yield
+
+    def export_project(self, project_id):
+        with self.count_queries('project'):
+            response = self.view(self.request, pk=project_id, format='xml')
+        return canonical_xml(response.content.decode())
+
+    def report(self, project_count):
+        details = ', '.join(f'{phase}={count}' for phase, count in sorted(self.queries.items()))
+        print(f"[SQL] {sum(self.queries.values())} requêtes pour {project_count} projets ({details})")
+
+
+def value_key(value):
+    """Clé de tri d'un élément <value> selon VALUE_ORDER (les index sont comparés comme des nombres)."""
+    key = []
+    for name in VALUE_ORDER:
+        element = value.find(name)
+        text = '' if element is None else (element.text or '').strip() or next(iter(element.attrib.values()), '')
+        key.append((0, int(text), '') if text.lstrip('-').isdigit() else (1, 0, text))
+    return key
+
+
+def canonical_xml(xml: str) -> str:
+    """Forme canonique d'un export XML RDMO : champs volatils retirés, valeurs triées selon VALUE_ORDER,
+    indentation fixe. Deux exports des mêmes réponses donnent le même texte, donc le même blob git."""
+    for prefix, uri in {ns for _, ns in ET.iterparse(StringIO(xml), events=['start-ns'])}:
+        ET.register_namespace(prefix, uri)
+    root = ET.fromstring(xml)
+    for field in VOLATILE_FIELDS:
+        root.attrib.pop(field, None)
+    for parent in root.iter():
+        for child in [child for child in parent if child.tag in VOLATILE_FIELDS]:
+            parent.remove(child)
+    for values in root.iter('values'):
+        values[:] = sorted(values, key=value_key)
+    ET.indent(root)
+    return '<?xml version="1.0" encoding="utf-8"?>\n' + ET.tostring(root, encoding='unicode') + '\n'
+
+
+def get_exporter():
+    global exporter
+    if exporter is None:
+        exporter = ExportContext()
+    return exporter
+
+
+def export_project(project_id):
+    return get_exporter().export_project(project_id)
+
+
+def export_project_in_worker(project_id):
+    """Rendu dans un worker : renvoie aussi le nombre de requêtes SQL et la durée, que le parent enregistre."""
+    context = get_exporter()
+    before = context.queries['project']
+    started = perf_counter()
+    xml = context.export_project(project_id)
+    return xml, context.queries['project'] - before, perf_counter() - started
+
+
+def render_projects(project_ids, workers=1):
+    """Rend le XML des projets, dans l'ordre de project_ids.
+    Avec workers > 1 le rendu est réparti sur des processus (fork) qui ont chacun leur connexion
+    à la base ; les écritures et les commits restent dans le processus parent."""
+    if workers <= 1 or len(project_ids) <= 1:
+        for project_id in project_ids:
+            with METRICS.timer('render'):
+                xml = export_project(project_id)
+            yield xml
+        return
+
+    # les workers ne doivent pas hériter de la connexion du parent, ils ouvrent la leur
+    from django.db import connections
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        for xml, queries, seconds in executor.map(export_project_in_worker, project_ids):
+            get_exporter().queries['project'] += queries
+            METRICS.observe('render', seconds)
+            yield xml
+
+
+class CatalogCache:
+    """Cache disque des catalogues rendus, conservé d'un run à l'autre.
+    Clé : id du catalogue + empreinte de sa version, un catalogue inchangé n'est donc jamais re-rendu.
+    Les écritures sont atomiques (fichier temporaire puis rename) : plusieurs processus peuvent le partager.
+    Au-delà de max_size octets, les entrées les moins récemment utilisées sont supprimées."""
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.elements_state = None
+
+    def fingerprint(self, catalog_id):
+        """Date de modification du catalogue, état (nombre, dernière modification) de chaque type
+        d'élément et version de RDMO, dont dépend le rendu."""
+        from django.db.models import Count, Max
+        from rdmo import __version__ as rdmo_version
+        from rdmo.conditions.models import Condition
+        from rdmo.domain.models import Attribute
+        from rdmo.options.models import Option, OptionSet
+        from rdmo.questions.models import Catalog, Page, Question, QuestionSet, Section
+        if self.elements_state is None:
+            self.elements_state = [
+                model.objects.aggregate(count=Count('id'), updated=Max('updated'))
+                for model in (Section, Page, QuestionSet, Question, Attribute, OptionSet, Option, Condition)
+            ]
+        updated = Catalog.objects.filter(id=catalog_id).values_list('updated', flat=True).first()
+        data = f'{rdmo_version}|{updated}|{self.elements_state}'
+        return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    def get(self, catalog_id, fingerprint):
+        path = self.path / f'{catalog_id}-{fingerprint}.xml'
+        try:
+            content = path.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # pour l'éviction LRU
+        return content
+
+    def put(self, catalog_id, fingerprint, content):
+        path = self.path / f'{catalog_id}-{fingerprint}.xml'
+        tmp_path = self.path / f'.{path.name}.{os.getpid()}.tmp'
+        tmp_path.write_text(content, encoding='utf-8')
+        os.replace(tmp_path, path)
+
+        # les anciennes versions de ce catalogue ne serviront plus
+        for old_path in self.path.glob(f'{catalog_id}-*.xml'):
+            if old_path != path:
+                old_path.unlink(missing_ok=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry_path in self.path.glob('*.xml'):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            entry_path.unlink(missing_ok=True)
+            total -= size
+
+
+def export_catalog(catalog_id):
+    if catalog_id not in catalogs:
+        if catalog_cache is None:
+            catalogs[catalog_id] = render_catalog(catalog_id)
+        else:
+            fingerprint = catalog_cache.fingerprint(catalog_id)
+            xml = catalog_cache.get(catalog_id, fingerprint)
+            METRICS.inc('catalog_cache_hits' if xml is not None else 'catalog_cache_misses')
+            if xml is None:
+                print(f"[INFO] Rendu du catalogue {catalog_id}")
+                xml = render_catalog(catalog_id)
+                catalog_cache.put(catalog_id, fingerprint, xml)
+            catalogs[catalog_id] = xml
+
+    return catalogs[catalog_id]
+
+
+def render_catalog(catalog_id):
+    from rdmo.core.exports import XMLResponse
+    from rdmo.questions.models import Catalog
+    from rdmo.questions.renderers import CatalogRenderer
+    from rdmo.questions.serializers.export import CatalogExportSerializer
+    with METRICS.timer('catalog_render'):
+        catalog = Catalog.objects.get(id=catalog_id)
+        catalog.prefetch_elements()
+        serializer = CatalogExportSerializer(catalog)
+        xml = CatalogRenderer().render([serializer.data], context={
+            'sections': True,
+            'pages': True,
+            'questionsets': True,
+            'questions': True,
+            'attributes': True,
+            'optionsets': True,
+            'options': True,
+            'conditions': True
+        })
+        return canonical_xml(XMLResponse(xml, name='catalogs').content.decode())
+
+
+def shared_catalog_pointer(base_path: Path, catalog_id, batch=None):
+    """Écrit la version courante du catalogue une seule fois dans le dépôt partagé base_path/catalogs
+    (commit seulement si elle a changé) et retourne le contenu du pointeur à mettre dans les projets.
+    Le pointeur ne nomme que le catalogue et son fichier : une nouvelle version ne touche pas les projets,
+    `git -C catalogs log -- <id>.xml` donne l'historique. Un commit en échec est compté dans
+    exporter.store_failures."""
+    if catalog_id not in catalog_pointers:
+        store_path = base_path / CATALOG_STORE
+        store_path.mkdir(exist_ok=True, parents=True)
+        catalog_xml = export_catalog(catalog_id)
+        catalog_path = store_path / f'{catalog_id}.xml'
+        if write_if_changed(catalog_path, catalog_xml):
+            if batch is not None:
+                # en mode monorepo, le dossier catalogs fait partie du dépôt unique
+                batch.add(f"catalogue {catalog_id}", [catalog_path])
+            else:
+                try:
+                    git_commit(store_path, {catalog_path.name: catalog_path.read_bytes()}, f"Update catalog {catalog_id}",
+                               author=export_author(), committer=export_author())
+                    print(f"[GIT] Catalogue {catalog_id} mis à jour dans {store_path}")
+                except Exception as e:
+                    print(f"[ERREUR] Git add/commit a échoué pour {store_path} : {e}")
+                    traceback.print_exc()
+                    forget_blobs([catalog_path])
+                    exporter.store_failures += 1
+        catalog_pointers[catalog_id] = (
+            f'catalog: {catalog_id}\n'
+            f'path: {CATALOG_STORE}/{catalog_id}.xml\n'
+        )
+    return catalog_pointers[catalog_id]
+
+
+def refresh_catalog_store(base_path: Path, catalog_ids, batch=None):
+    """Option shared_catalogs : écrit dans le dépôt partagé la nouvelle version des catalogues modifiés
+    qu'utilise au moins un projet. Les pointeurs des projets ne changent pas et ne sont pas réécrits."""
+    from rdmo.projects.models import Project
+    used = set(Project.objects.filter(catalog_id__in=catalog_ids).values_list('catalog_id', flat=True))
+    for catalog_id in sorted(used):
+        shared_catalog_pointer(base_path, catalog_id, batch)
+
+
+def write_if_changed(path: Path, new_content: str) -> bool:
+    """Écrit le fichier seulement si le contenu a changé. Retourne True si modifié.
+    Le blob git du nouveau contenu est comparé à celui de l'index des blobs : le fichier existant
+    n'est pas relu, et le contenu n'est encodé qu'une fois pour le hash et l'écriture."""
+    with METRICS.timer('hash_compare'):
+        data = new_content.encode('utf-8')
+        new_sha = git_blob_sha(data)
+        if path.exists() and blob_index.get(path) == new_sha:
+            METRICS.inc('files_unchanged')
+            return False  # Pas de changement
+
+        path.write_bytes(data)
+        blob_index.set(path, new_sha)
+    METRICS.inc('files_written')
+    return True
+
+
+class BlobIndex:
+    """Blob git de chaque fichier écrit par l'export (chemin relatif à base_path -> sha), conservé entre
+    les runs dans base_path/.export_blobs. Un fichier absent de l'index (premier run) est cherché dans
+    l'arbre HEAD de son dépôt, puis le résultat est gardé. Le fichier n'est réécrit que si l'index a changé."""
+
+    def __init__(self, base_path: Path):
+        self.base_path = base_path.resolve()
+        self.path = base_path / BLOB_INDEX_FILE
+        try:
+            self.blobs = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.blobs = {}
+        self.changed = False
+
+    def key(self, path: Path):
+        return path.resolve().relative_to(self.base_path).as_posix()
+
+    def get(self, path: Path):
+        key = self.key(path)
+        if key not in self.blobs:
+            self.blobs[key] = head_blob_sha(path.resolve())
+            self.changed = True
+        return self.blobs[key]
+
+    def set(self, path: Path, sha):
+        self.blobs[self.key(path)] = sha
+        self.changed = True
+
+    def forget(self, path: Path):
+        """Oublie le blob écrit (commit en échec) : il sera relu dans l'arbre HEAD au prochain run."""
+        self.blobs.pop(self.key(path), None)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+        tmp_path.write_text(json.dumps(self.blobs, sort_keys=True))
+        os.replace(tmp_path, self.path)
+
+
+class MonorepoBatch:
+    """Mode monorepo (option monorepo) : un seul dépôt git à la racine de l'export, un dossier par projet.
+    Les fichiers modifiés sont commités par lots de batch_size projets, avec comme date la date RDMO
+    la plus récente du lot. `git log -- <id>/` donne l'historique d'un projet. Les fichiers ajoutés avec leur
+    projet sont enregistrés dans l'index des commits une fois le lot commité."""
+
+    def __init__(self, root: Path, batch_size, fast_import_threshold=200):
+        from git import Repo
+        root.mkdir(exist_ok=True, parents=True)
+        self.root = root.resolve()
+        if (self.root / '.git').exists():
+            self.repo = Repo(self.root)
+        else:
+            self.repo = Repo.init(self.root)
+            print(f"[GIT] Nouveau dépôt initialisé dans {self.root}")
+            # fichiers de travail de l'export, à la racine mais non versionnés
+            with open(self.root / '.git' / 'info' / 'exclude', 'a', encoding='utf-8') as f:
+                f.write(f".catalog_cache/\n{WATERMARK_FILE}\n{CATALOGS_FILE}\n{BLOB_INDEX_FILE}\n{HISTORY_DB}*\n")
+        self.batch_size = batch_size
+        self.fast_import_threshold = fast_import_threshold
+        self.files = []
+        self.labels = []
+        self.projects = []
+        self.date = None
+        self.failures = 0
+
+    def add(self, label, files, date=None, project=None):
+        self.files.extend(files)
+        self.labels.append(label)
+        if project is not None:
+            self.projects.append((project, [f.resolve() for f in files]))
+        if date is not None:
+            if date.tzinfo is None:
+                date = date.astimezone()
+            self.date = date if self.date is None else max(self.date, date)
+        if len(self.labels) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.labels:
+            return
+        files, labels, projects, date = self.files, self.labels, self.projects, self.date or datetime.now().astimezone()
+        self.files, self.labels, self.projects, self.date = [], [], [], None
+
+        paths = [(f, str(f.resolve().relative_to(self.root))) for f in files]
+        commit_msg = f"Update {len(labels)} project(s) on {date.strftime('%Y-%m-%d %H:%M:%S')}\n\n" + '\n'.join(f'- {label}' for label in labels)
+
+        try:
+            if len(labels) >= self.fast_import_threshold:
+                sha = fast_import(self.root, [{
+                    'files': {path: f.read_bytes() if f.exists() else None for f, path in paths},
+                    'message': commit_msg,
+                    'author': export_author(),
+                    'committer': export_author(),
+                    'date': date,
+                }])
+            else:
+                sha = git_commit(
+                    self.root,
+                    {path: f.read_bytes() if f.exists() else None for f, path in paths},
+                    commit_msg,
+                    author=export_author(),
+                    committer=export_author(),
+                    author_date=date,
+                    commit_date=date,
+                )
+        except Exception as e:
+            print(f"[ERREUR] Git add/commit du lot a échoué : {e}")
+            traceback.print_exc()
+            forget_blobs(files)
+            self.failures += 1
+            return
+        print(f"[GIT] ✅ Lot de {len(labels)} projet(s) commité : {sha[:10]}")
+        record_export_commit(self.root, sha, projects)
@@ -1,27 +1,104 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*
 import os
+import re
+import sys
 import json
-import shutil
+import sqlite3
+import signal
+import fcntl
 import subprocess
+import shutil
+import hashlib
+import hmac
 import traceback
-import requests
+import argparse
 from pathlib import Path
-from datetime import datetime
-from git import Repo
+from time import monotonic, perf_counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Event, Thread
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+# requests et GitPython sont importés dans les fonctions qui s'en servent : `status` ou `--help`
+# n'ont pas à les charger (voir main)
+# API, métriques et commits git communs avec les scripts d'export : rdmo_common.py, à côté de ce script
+from rdmo_common import (
+    TOKEN, MYRDMO, LISTE_PROJET_URL, HTTP_CHUNK_SIZE, api_get, iter_listing, iter_remote_projects, safe_title,
+    METRICS, COMMIT_STATS, write_atomic, repo_lock, git_commit, fast_import,
+    HISTORY_DB, history_time, open_history, record_commit,
+)
 
 
 ##########################################################################################################################################################################################################################################################################################
 ####   Récupère les variables d'environnement
 ##########################################################################################################################################################################################################################################################################################
 
-TOKEN = os.environ["TOKENRDMO"]
-MYRDMO = os.environ["MYRDMO"]
+# TOKENRDMO et MYRDMO (lus dans rdmo_common) ne sont obligatoires que pour les commandes qui appellent l'API
+# (voir check_api_env)
+OLD_LISTE_FILE = "old_liste_projet.json"  # ancien fichier de référence, repris une fois dans la base d'état
+STATE_DB = os.environ.get("RDMO_STATE_DB", "sync_state.sqlite3")
+# RDMO_FULL_SYNC=1 force le listing complet (sinon incrémental dès qu'un watermark existe)
+FULL_SYNC = os.environ.get("RDMO_FULL_SYNC", "") not in ("", "0")
+
+# Champs des valeurs retirés avant écriture : ils changent sans que les réponses changent
+VOLATILE_FIELDS = [f for f in os.environ.get("RDMO_VOLATILE_FIELDS", "created,updated").split(",") if f]
+# Ordre canonique des valeurs d'un projet
+VALUE_ORDER = ("snapshot", "attribute", "set_prefix", "set_index", "collection_index", "id")
+
+# Disposition des valeurs dans le dossier d'un projet : "single" (un seul {titre}.json), "attribute" (un fichier
+# par attribut) ou "set" (un fichier par set_prefix/set_index) dans values/. Avec un découpage, seuls les fichiers
+# dont le contenu a changé sont réécrits et commités : une réponse modifiée ne coûte plus tout le projet.
+VALUES_LAYOUT = os.environ.get("RDMO_VALUES_LAYOUT", "single")
+VALUES_LAYOUTS = ("single", "attribute", "set")
+SHARD_DIR = "values"
+# hash de chaque fichier du découpage tel que commité, pour ne pas relire les fichiers. Le nouveau manifeste
+# est d'abord écrit dans SHARD_MANIFEST_PENDING et ne le remplace qu'après un commit réussi (confirm_shards)
+SHARD_MANIFEST = ".shards.json"
+SHARD_MANIFEST_PENDING = ".shards.json.pending"
+
+# Nombre de projets téléchargés en parallèle
+SYNC_WORKERS = int(os.environ.get("RDMO_SYNC_WORKERS", "8"))
+
+# Mode monorepo : RDMO_MONOREPO=/chemin/du/depot -> un seul dépôt git, un dossier par projet,
+# commits par lots de RDMO_BATCH_SIZE projets. Sinon un dépôt git par projet dans le dossier courant.
+MONOREPO = os.environ.get("RDMO_MONOREPO")
+BATCH_SIZE = int(os.environ.get("RDMO_BATCH_SIZE", "500"))
+
+# Mode monorepo : un lot d'au moins ce nombre de projets est commité par `git fast-import`
+FAST_IMPORT_THRESHOLD = int(os.environ.get("RDMO_FAST_IMPORT_THRESHOLD", "200"))
+
+# Chemins absolus : les fichiers sont écrits et commités depuis plusieurs threads
+BASE_DIR = Path(MONOREPO).resolve() if MONOREPO else Path.cwd()
+
+# Mode démon (`sync_rdmo_projects.py serve [intervalle]`) : un cycle toutes les RDMO_POLL_INTERVAL secondes.
+# Le fichier verrou empêche deux synchronisations simultanées du même dossier (cron et démon par ex.)
+POLL_INTERVAL = float(os.environ.get("RDMO_POLL_INTERVAL", "60"))
+RUN_LOCK_FILE = ".sync.lock"
+STOP = Event()
+
+# Notifications "projet X modifié" en mode démon : RDMO_WEBHOOK_PORT active un serveur HTTP local qui
+# accepte POST /projects/<id> (en-tête X-Webhook-Token si RDMO_WEBHOOK_TOKEN est défini). Les notifications
+# d'un projet sont regroupées jusqu'à RDMO_WEBHOOK_DELAY secondes sans nouvelle notification.
+WEBHOOK_HOST = os.environ.get("RDMO_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("RDMO_WEBHOOK_PORT", "0"))
+WEBHOOK_TOKEN = os.environ.get("RDMO_WEBHOOK_TOKEN")
+WEBHOOK_DELAY = float(os.environ.get("RDMO_WEBHOOK_DELAY", "2"))
+WAKE = Event()  # réveille la boucle du démon (notification ou arrêt)
+
+# Métriques par phase (voir Metrics) : rapport JSON et fichier textfile Prometheus, écrits à chaque fin de cycle
+METRICS_JSON = os.environ.get("RDMO_METRICS_JSON")
+METRICS_PROM = os.environ.get("RDMO_METRICS_PROM")
+
+# Maintenance des dépôts (commande `maintain`, ou en fin de cycle si RDMO_MAINTENANCE_INTERVAL secondes se sont
+# écoulées depuis la dernière) : git gc puis commit-graph, en commençant par les dépôts qui ont le plus d'objets isolés.
+# RDMO_MAINTENANCE_WORKERS processus git au plus en même temps, en priorité d'E/S basse (ionice) ; après
+# RDMO_MAINTENANCE_BUDGET secondes, les dépôts restants sont reportés au passage suivant.
+MAINTENANCE_INTERVAL = float(os.environ.get("RDMO_MAINTENANCE_INTERVAL", "0"))  # 0 : seulement avec `maintain`
+MAINTENANCE_WORKERS = int(os.environ.get("RDMO_MAINTENANCE_WORKERS", "2"))
+MAINTENANCE_MIN_LOOSE = int(os.environ.get("RDMO_MAINTENANCE_MIN_LOOSE", "100"))
+MAINTENANCE_BUDGET = float(os.environ.get("RDMO_MAINTENANCE_BUDGET", "0"))  # 0 : pas de limite
 
-HEADERS = {"Authorization": f"Token {TOKEN}"}
-LISTE_PROJET_URL = f"{MYRDMO}/api/v1/projects/projects/"
-LISTE_FILE = "liste_projet.json"
-OLD_LISTE_FILE = "old_liste_projet.json"
 
 
 
@@ -29,126 +106,1155 @@ OLD_LISTE_FILE = "old_liste_projet.json"
 ####   definition des fonctions
 ##########################################################################################################################################################################################################################################################################################
 
-def run_curl(url, output_file):
-    cmd = [
-        "curl", "-s", "-w", "%{http_code}", "-LH", f"Authorization: Token {TOKEN}", url
-    ]
+def download_file(url, output_file):
+    """Télécharge url dans output_file en streaming, sans garder toute la réponse en mémoire.
+    Retourne le sha256 du contenu, calculé au fil du téléchargement."""
+    digest = hashlib.sha256()
+    with METRICS.timer("download"), api_get(url, stream=True) as response:
+        with open(output_file, "wb") as f:
+            for chunk in response.iter_content(chunk_size=HTTP_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                METRICS.inc("bytes_downloaded", len(chunk))
+    return digest.hexdigest()
+
+
+def sort_field(field):
+    """Clé de tri d'un champ : les nombres avant le texte, None en premier."""
+    if field is None:
+        return (0, 0, "")
+    if isinstance(field, (int, float)):
+        return (1, field, "")
+    return (2, 0, str(field))
+
+
+def value_key(value):
+    """Clé de tri d'une valeur selon VALUE_ORDER."""
+    if not isinstance(value, dict):
+        return []
+    return [sort_field(value.get(field)) for field in VALUE_ORDER]
+
+
+class HashingWriter:
+    """Fichier binaire ouvert en écriture qui calcule le sha256 de ce qu'on y écrit (texte ou octets)."""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.digest.update(data)
+        self.f.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def load_canonical_values(source):
+    """Lit la réponse /values dans source et la met sous forme canonique : valeurs triées par
+    attribut/set_prefix/set_index/collection_index, champs volatils retirés.
+    Retourne (réponse, liste des valeurs ou None) ; ValueError si source n'est pas du JSON."""
+    with open(source, "rb") as f:
+        payload = json.load(f)
+    values = payload.get("results") if isinstance(payload, dict) else payload
+    if not isinstance(values, list):
+        return payload, None
+    for value in values:
+        if isinstance(value, dict):
+            for field in VOLATILE_FIELDS:
+                value.pop(field, None)
+    values.sort(key=value_key)
+    return payload, values
+
+
+def write_canonical_values(payload, target):
+    """Écrit dans target la réponse canonique (voir load_canonical_values), clés triées et indentation
+    fixe. Deux téléchargements des mêmes réponses donnent les mêmes octets, donc le même hash et pas
+    de commit. Le JSON est écrit et haché en flux, sans construire le texte complet en mémoire.
+    Retourne le sha256 du contenu écrit."""
+    with open(target, "wb") as f:
+        writer = HashingWriter(f)
+        json.dump(payload, writer, ensure_ascii=False, sort_keys=True, indent=2)
+        writer.write("\n")
+    return writer.hexdigest()
+
+
+def shard_name(value):
+    """Fichier du découpage VALUES_LAYOUT (relatif au dossier du projet) qui contient cette valeur."""
+    if VALUES_LAYOUT == "attribute":
+        key = f"attribute_{value.get('attribute')}"
+    else:
+        key = f"set_{value.get('set_prefix') or ''}_{value.get('set_index')}"
+    return f"{SHARD_DIR}/{re.sub(r'[^A-Za-z0-9_.-]', '-', key)}.json"
+
+
+def read_shard_manifest_file(path: Path):
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        http_code = result.stdout[-3:]
-        body = result.stdout[:-3]
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
 
-        if http_code != "200":
-            print(f"[ERREUR] Code HTTP {http_code} pour {url}")
-            print(f"[DEBUG] Réponse : {body[:500]}...")  # Tronque pour pas spammer
-            raise Exception(f"Échec HTTP {http_code}")
 
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(body)
+def read_shard_manifest(folder: Path):
+    """Manifeste du dernier commit du découpage ({fichier: sha256})."""
+    return read_shard_manifest_file(folder / SHARD_MANIFEST)
 
-    except subprocess.CalledProcessError as e:
-        print(f"[ERREUR] curl a échoué pour {url}")
-        raise
+
+def write_value_shards(values, folder: Path, known):
+    """Écrit les valeurs canoniques en un fichier par shard_name. Seuls les fichiers dont le hash diffère
+    de known (manifeste du dernier commit) sont réécrits ; ceux qui n'ont plus de valeurs sont supprimés.
+    Le nouveau manifeste attend le commit dans SHARD_MANIFEST_PENDING : si le commit échoue, le passage
+    suivant compare encore au manifeste commité et reprend les mêmes fichiers.
+    Retourne (fichiers écrits ou supprimés, hash de l'ensemble des fichiers)."""
+    shards = {}
+    for value in values:
+        shards.setdefault(shard_name(value), []).append(value)
+    manifest = {}
+    changed = []
+    for name, shard in sorted(shards.items()):
+        content = (json.dumps(shard, ensure_ascii=False, sort_keys=True, indent=2) + "\n").encode("utf-8")
+        manifest[name] = hashlib.sha256(content).hexdigest()
+        path = folder / name
+        if known.get(name) != manifest[name] or not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.tmp")
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+            changed.append(path)
+    for name in sorted(known.keys() - manifest.keys()):
+        (folder / name).unlink(missing_ok=True)
+        changed.append(folder / name)
+    if manifest != known:
+        write_atomic(folder / SHARD_MANIFEST_PENDING, json.dumps(manifest, sort_keys=True, indent=2))
+    else:
+        (folder / SHARD_MANIFEST_PENDING).unlink(missing_ok=True)
+    content_hash = hashlib.sha256("".join(f"{name} {sha}\n" for name, sha in sorted(manifest.items())).encode("utf-8"))
+    return changed, content_hash.hexdigest()
 
 
-def safe_title(title):
-    return title.replace(" ", "_").replace("/", "-")
+def remove_value_shards(folder: Path):
+    """Retour à la disposition "single" : supprime les fichiers du découpage (le manifeste vide attend le
+    commit, voir confirm_shards). Retourne les fichiers supprimés."""
+    removed = []
+    for name in sorted(read_shard_manifest(folder)):
+        (folder / name).unlink(missing_ok=True)
+        removed.append(folder / name)
+    write_atomic(folder / SHARD_MANIFEST_PENDING, "{}")
+    return removed
 
-def fetch_all_projects():
-    headers = {"Authorization": f"Token {TOKEN}"}
-    url = LISTE_PROJET_URL
-    all_results = []
 
-    while url:
-        print(f"[INFO] Téléchargement de {url}")
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            print(f"[ERREUR] Code HTTP {response.status_code} pour {url}")
-            print(f"[DEBUG] Réponse : {response.text[:500]}...")
-            raise Exception(f"Échec HTTP {response.status_code}")
-
-        data = response.json()
-        all_results.extend(data.get("results", []))
+def confirm_shards(folder: Path):
+    """Après un commit réussi : le manifeste en attente devient le manifeste commité."""
+    pending = folder / SHARD_MANIFEST_PENDING
+    if not pending.exists():
+        return
+    if read_shard_manifest_file(pending):
+        os.replace(pending, folder / SHARD_MANIFEST)
+    else:
+        (folder / SHARD_MANIFEST).unlink(missing_ok=True)
+        pending.unlink()
+
+
+def exclude_from_repo(repo_path: Path, patterns):
+    """Ajoute à .git/info/exclude de repo_path les motifs qui n'y sont pas encore (fichiers de travail non versionnés)."""
+    exclude = repo_path / ".git" / "info" / "exclude"
+    exclude.parent.mkdir(exist_ok=True)
+    lines = exclude.read_text(encoding="utf-8").splitlines() if exclude.exists() else []
+    missing = [pattern for pattern in patterns if pattern not in lines]
+    if missing:
+        with open(exclude, "a", encoding="utf-8") as f:
+            f.write("".join(f"{pattern}\n" for pattern in missing))
+
+
+def project_folder(project_id, title):
+    return BASE_DIR / f"{project_id}_{safe_title(title)}"
+
+
+def repo_files(root: Path, paths):
+    """{chemin relatif à root: contenu, ou None pour un fichier supprimé} pour git_commit et fast_import."""
+    return {path.relative_to(root).as_posix(): path.read_bytes() if path.exists() else None for path in paths}
+
+
+def parse_date(value):
+    """Date ISO 8601 de l'API -> datetime comparable (les chaînes ne le sont pas selon le fuseau)."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def iter_changed_projects(since):
+    """Itère sur les projets modifiés depuis since, en demandant à l'API un tri par last_changed
+    décroissant et en s'arrêtant au premier projet qui passe sous since.
+    On ne fait confiance au tri que si toute la première page est triée (au moins deux projets) :
+    sinon, ou si une page suivante ne l'est pas, on retombe sur le listing complet."""
+    url = f"{LISTE_PROJET_URL}?ordering=-last_changed"
+    since = parse_date(since)
+    print(f"[INFO] Téléchargement de {url}")
+    with METRICS.timer("listing_page"):
+        data = api_get(url).json()
+    results = data.get("results", [])
+    dates = [parse_date(proj["last_changed"]) for proj in results]
+    if not data.get("next") and len(results) < 2:
+        # tout le listing tient sur cette page : rien à trier
+        yield from results
+        return
+    if len(results) < 2 or any(later > earlier for earlier, later in zip(dates, dates[1:])):
+        print("[WARN] Tri par last_changed non vérifiable sur la première page, listing complet")
+        yield from iter_remote_projects()
+        return
+
+    previous = None
+    while True:
+        for proj, changed in zip(results, dates):
+            if previous is not None and changed > previous:
+                print("[WARN] L'API ne trie pas par last_changed, listing complet")
+                yield from iter_remote_projects()
+                return
+            if changed < since:
+                return
+            previous = changed
+            yield proj
         url = data.get("next")
+        if not url:
+            return
+        print(f"[INFO] Téléchargement de {url}")
+        with METRICS.timer("listing_page"):
+            data = api_get(url).json()
+        results = data.get("results", [])
+        dates = [parse_date(proj["last_changed"]) for proj in results]
+
+
+def open_state(path):
+    """Ouvre (et crée si besoin) la base SQLite d'état de synchronisation, indexée par id de projet."""
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            last_changed TEXT,
+            synced_changed TEXT,
+            content_hash TEXT,
+            raw_hash TEXT,
+            commit_sha TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            listed_at TEXT,
+            synced_at TEXT
+        )
+    """)
+    if "raw_hash" not in {column["name"] for column in db.execute("PRAGMA table_info(projects)")}:
+        # base créée avant le hash de la réponse brute
+        db.execute("ALTER TABLE projects ADD COLUMN raw_hash TEXT")
+    db.execute("CREATE INDEX IF NOT EXISTS projects_status ON projects (status, listed_at)")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    db.commit()
+    return db
+
+
+def get_meta(db, key):
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def set_meta(db, key, value):
+    with db:
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def import_legacy_listing(db, filename):
+    """Reprend old_liste_projet.json comme état de départ pour ne pas tout retélécharger."""
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO projects (id, title, last_changed, synced_changed, status) VALUES (?, ?, ?, ?, 'synced')",
+            ((proj["id"], proj["title"], proj["last_changed"], proj["last_changed"]) for proj in iter_listing(filename))
+        )
 
-    with open(LISTE_FILE, "w", encoding="utf-8") as f:
-        json.dump({"results": all_results}, f, ensure_ascii=False, indent=2)
 
+def record_listing(db, projects, listed_at):
+    """Enregistre le listing distant au fil de l'eau. Un projet dont last_changed diffère
+    de la dernière synchro réussie repasse en 'pending'. Retourne le nombre de projets listés."""
+    count = 0
+    with db:
+        for proj in projects:
+            db.execute("""
+                INSERT INTO projects (id, title, last_changed, listed_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    title = excluded.title,
+                    last_changed = excluded.last_changed,
+                    listed_at = excluded.listed_at,
+                    status = CASE WHEN synced_changed IS excluded.last_changed THEN status ELSE 'pending' END
+            """, (proj["id"], proj["title"], proj["last_changed"], listed_at))
+            count += 1
+    return count
 
-def parse_projects(filename):
-    with open(filename, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return {
-        proj["id"]: {
-            "title": proj["title"],
-            "last_changed": proj["last_changed"]
-        }
-        for proj in data["results"]
-    }
 
-def download_and_commit_project(project_id, title):
-    from time import sleep
+def pending_projects(db, listed_at):
+    """Projets encore présents sur le serveur et pas synchronisés (nouveaux, modifiés ou en échec)."""
+    return db.execute(
+        "SELECT * FROM projects WHERE status != 'synced' AND listed_at = ? ORDER BY id", (listed_at,)
+    ).fetchall()
 
-    folder = Path(f"{project_id}_{safe_title(title)}")
+
+def update_watermark(db, listed_at):
+    """Avance le watermark (last_changed en dessous duquel tout est synchronisé).
+    S'il reste des projets non synchronisés, il s'arrête au plus ancien pour qu'ils soient relistés."""
+    rows = db.execute("SELECT last_changed, status FROM projects WHERE listed_at = ?", (listed_at,)).fetchall()
+    candidates = [row["last_changed"] for row in rows if row["status"] != "synced"]
+    if not candidates:
+        candidates = [row["last_changed"] for row in rows]
+        watermark = get_meta(db, "watermark")
+        if watermark:
+            candidates.append(watermark)
+        if not candidates:
+            return
+        set_meta(db, "watermark", max(candidates, key=parse_date))
+    else:
+        set_meta(db, "watermark", min(candidates, key=parse_date))
+
+
+def mark_pending(db, project_ids):
+    """Force la synchronisation des projets project_ids, même si leur last_changed n'a pas bougé."""
+    with db:
+        db.executemany("UPDATE projects SET status = 'pending' WHERE id = ?", [(pid,) for pid in project_ids])
+
+
+def mark_synced(db, row, content_hash, commit_sha, raw_hash=None):
+    with db:
+        db.execute("""
+            UPDATE projects SET status = 'synced', error = NULL, synced_changed = ?, content_hash = ?, raw_hash = ?,
+                commit_sha = COALESCE(?, commit_sha), synced_at = ?
+            WHERE id = ?
+        """, (row["last_changed"], content_hash, raw_hash, commit_sha, datetime.now(timezone.utc).isoformat(), row["id"]))
+    METRICS.inc("projects_synced")
+    if commit_sha is None:
+        METRICS.inc("projects_unchanged")
+
+
+def mark_failed(db, row, error):
+    with db:
+        db.execute("UPDATE projects SET status = 'failed', error = ? WHERE id = ?", (error, row["id"]))
+    METRICS.inc("projects_failed")
+
+
+def download_project(project_id, title, old_hash=None, old_raw_hash=None):
+    """Télécharge les valeurs du projet dans son dossier, sous forme canonique (voir write_canonical_values).
+    La réponse est écrite en flux dans un fichier temporaire, qui ne remplace le fichier du projet
+    (renommage atomique) que si le hash diffère de old_hash. Avec RDMO_VALUES_LAYOUT=attribute ou set, les
+    valeurs sont découpées en plusieurs fichiers (voir write_value_shards).
+    Si le sha256 de la réponse brute, calculé pendant le téléchargement, est old_raw_hash, le contenu
+    canonique est celui déjà écrit : ni lecture du JSON ni écriture, old_hash est retourné.
+    Retourne (fichiers à commiter, hash du contenu canonique, hash de la réponse brute)."""
+    folder = project_folder(project_id, title)
     folder.mkdir(exist_ok=True)
     output_file = folder / f"{safe_title(title)}.json"
+    raw_file = folder / f".{output_file.name}.download"
+    tmp_file = folder / f".{output_file.name}.tmp"
 
+    # Le téléchargement se fait en parallèle (plusieurs workers)
     url = f"{MYRDMO}/api/v1/projects/projects/{project_id}/values"
-    run_curl(url, str(output_file))
+    try:
+        raw_hash = download_file(url, raw_file)
+        written = (folder / SHARD_MANIFEST).exists() if VALUES_LAYOUT != "single" else output_file.exists()
+        if old_hash is not None and raw_hash == old_raw_hash and written:
+            METRICS.inc("projects_raw_unchanged")
+            return [], old_hash, raw_hash
+        content_hash = raw_hash
+        with METRICS.timer("hash_compare"):
+            try:
+                payload, values = load_canonical_values(raw_file)
+            except ValueError:
+                print(f"[INFO] Réponse non JSON pour {title}, gardée telle quelle")
+                payload = values = None
+                os.replace(raw_file, tmp_file)
 
-    sleep(0.5)  # Pour éviter les problèmes de détection de fichier
-    if not output_file.exists():
-        print(f"[ERREUR] Le fichier {output_file} n’a pas été créé.")
-        return
+            if VALUES_LAYOUT != "single" and values is not None:
+                # le manifeste ne vaut que si les fichiers sont déjà commités (dépôt existant)
+                known = read_shard_manifest(folder) if MONOREPO or (folder / ".git").exists() else {}
+                files, content_hash = write_value_shards(values, folder, known)
+                if output_file.exists():
+                    output_file.unlink()
+                    files.append(output_file)
+                return files, content_hash, raw_hash
 
-    if not (folder / ".git").exists():
-        repo = Repo.init(folder)
-    else:
-        repo = Repo(folder)
+            if payload is not None:
+                content_hash = write_canonical_values(payload, tmp_file)
+            files = remove_value_shards(folder) if (folder / SHARD_MANIFEST).exists() else []
+            if content_hash != old_hash or not output_file.exists():
+                os.replace(tmp_file, output_file)
+            files.append(output_file)
+    finally:
+        raw_file.unlink(missing_ok=True)
+        tmp_file.unlink(missing_ok=True)
+    return files, content_hash, raw_hash
+
+
+def download_and_commit_project(project_id, title, old_hash=None, old_raw_hash=None):
+    """Télécharge les valeurs du projet et les commit dans le dépôt du projet si leur contenu a changé.
+    Retourne (hash du contenu, sha du commit ou None s'il n'y a rien eu à commiter, fichiers commités,
+    hash de la réponse brute)."""
+    files, content_hash, raw_hash = download_project(project_id, title, old_hash, old_raw_hash)
+    folder = project_folder(project_id, title)
+    if (content_hash == old_hash and (folder / ".git").exists()) or not files:
+        print(f"[SKIP] {title} : contenu inchangé")
+        confirm_shards(folder)
+        return content_hash, None, [], raw_hash
 
-    original_dir = os.getcwd()
     try:
-        os.chdir(folder)
-        repo.index.add([output_file.name])
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        repo.index.commit(f"Update on {now}")
+        commit_sha = git_commit(
+            folder, repo_files(folder, files),
+            f"Update on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        )
     except Exception as e:
-        print(f"[ERREUR] Git add/commit a échoué pour {output_file} : {e}")
-        print(f"[DEBUG] Répertoire courant : {os.getcwd()}")
-        import traceback
+        print(f"[ERREUR] Git add/commit a échoué pour {folder} : {e}")
         traceback.print_exc()
-    finally:
-        os.chdir(original_dir)
+        raise
+    exclude_from_repo(folder, [f"{SHARD_MANIFEST}*"])
+    confirm_shards(folder)
+    return content_hash, commit_sha, files, raw_hash
+
+
+class MonorepoBatch:
+    """Mode monorepo : un seul dépôt git (BASE_DIR) avec un dossier par projet.
+    Les projets téléchargés sont commités par lots de batch_size, la date du commit est le
+    last_changed RDMO le plus récent du lot. `git log -- '<id>_*'` donne l'historique d'un projet."""
+
+    def __init__(self, root, batch_size):
+        from git import Repo
+        self.root = root
+        if (root / ".git").exists():
+            self.repo = Repo(root)
+        else:
+            self.repo = Repo.init(root)
+        # la base d'état, l'index et les manifestes vivent dans le dépôt mais ne sont pas versionnés
+        exclude_from_repo(root, [f"{STATE_DB}*", RUN_LOCK_FILE, f"{SHARD_MANIFEST}*", f"{HISTORY_DB}*"])
+        self.batch_size = batch_size
+        self.entries = []  # (ligne de la base d'état, fichiers, hash du contenu)
+
+    def add(self, row, files, content_hash):
+        self.entries.append((row, files, content_hash))
+        return len(self.entries) >= self.batch_size
+
+    def flush(self):
+        """Commit le lot courant. Retourne (entrées commitées, sha du commit)."""
+        entries, self.entries = self.entries, []
+        if not entries:
+            return entries, None
+
+        date = max((parse_date(row["last_changed"]) for row, _, _ in entries), default=None)
+        files = repo_files(self.root, [path for _, paths, _ in entries for path in paths])
+        message = f"Update {len(entries)} project(s)\n\n" + "\n".join(
+            f"- {row['id']} ({row['title']}) {row['last_changed']}" for row, _, _ in entries
+        )
+        if len(entries) >= FAST_IMPORT_THRESHOLD:
+            from git import Actor
+            config = self.repo.config_reader()
+            commit_sha = fast_import(self.root, [{
+                "files": files,
+                "message": message,
+                "author": Actor.author(config),
+                "committer": Actor.committer(config),
+                "date": date,
+            }])
+        else:
+            commit_sha = git_commit(self.root, files, message, author_date=date, commit_date=date)
+        print(f"[GIT] Lot de {len(entries)} projet(s) commité : {commit_sha[:10]}")
+        return entries, commit_sha
+
+
+def sync_projects(db, todo, batch=None):
+    """Télécharge et commit les projets de todo (lignes de la base d'état) avec SYNC_WORKERS workers.
+    L'état de chaque projet est enregistré dès qu'il est terminé (en mode monorepo, dès que son lot
+    est commité), une erreur n'interrompt pas les autres. Après un arrêt demandé (STOP), les projets
+    pas encore commencés restent à faire pour le cycle suivant. Retourne (succès, échecs)."""
+    successes = []
+    failures = {}
+    COMMIT_STATS.reset()
+    if batch is None and MONOREPO:
+        batch = MonorepoBatch(BASE_DIR, BATCH_SIZE)
+    history = open_history(BASE_DIR)
+    # hash de la réponse brute des projets en attente dans le lot, enregistré une fois le lot commité
+    raw_hashes = {}
+
+    def flush_batch():
+        pending = list(batch.entries)
+        try:
+            entries, commit_sha = batch.flush()
+        except Exception as e:
+            print(f"[ERREUR] Git add/commit du lot a échoué : {e}")
+            traceback.print_exc()
+            for row, _, _ in pending:
+                raw_hashes.pop(row["id"], None)
+                mark_failed(db, row, str(e))
+                failures[row["id"]] = str(e)
+            return
+        if commit_sha:
+            record_commit(history, batch.root, commit_sha, [
+                (row["id"], row["last_changed"], files, content_hash) for row, files, content_hash in entries
+            ])
+        for row, _, content_hash in entries:
+            confirm_shards(project_folder(row["id"], row["title"]))
+            mark_synced(db, row, content_hash, commit_sha, raw_hashes.pop(row["id"], None))
+            successes.append(row["id"])
+
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        if batch is None:
+            futures = {
+                executor.submit(download_and_commit_project, row["id"], row["title"], row["content_hash"], row["raw_hash"]): row
+                for row in todo
+            }
+        else:
+            futures = {
+                executor.submit(download_project, row["id"], row["title"], row["content_hash"], row["raw_hash"]): row
+                for row in todo
+            }
+
+        for future in as_completed(futures):
+            if STOP.is_set():
+                for pending in futures:
+                    pending.cancel()
+            if future.cancelled():
+                continue
+            row = futures[future]
+            try:
+                if batch is None:
+                    content_hash, commit_sha, files, raw_hash = future.result()
+                    if commit_sha:
+                        record_commit(history, project_folder(row["id"], row["title"]), commit_sha,
+                                      [(row["id"], row["last_changed"], files, content_hash)])
+                else:
+                    files, content_hash, raw_hash = future.result()
+                    if content_hash != row["content_hash"] and files:
+                        raw_hashes[row["id"]] = raw_hash
+                        if batch.add(row, files, content_hash):
+                            flush_batch()
+                        continue
+                    print(f"[SKIP] {row['title']} : contenu inchangé")
+                    confirm_shards(project_folder(row["id"], row["title"]))
+                    commit_sha = None
+                mark_synced(db, row, content_hash, commit_sha, raw_hash)
+                successes.append(row["id"])
+            except Exception as e:
+                print(f"[ERREUR] Projet {row['id']} ({row['title']}) : {e}")
+                mark_failed(db, row, str(e))
+                failures[row["id"]] = str(e)
+
+    if batch is not None:
+        flush_batch()
+    history.close()
+    return successes, failures
+
+
+def print_summary(successes, failures):
+    print(f"[RÉSUMÉ] {len(successes)} projet(s) synchronisé(s), {len(failures)} échec(s)")
+    COMMIT_STATS.report()
+    for pid, error in sorted(failures.items()):
+        print(f"         - {pid} : {error}")
+    METRICS.print_summary()
+    if METRICS_JSON:
+        METRICS.write_json(METRICS_JSON)
+    if METRICS_PROM:
+        METRICS.write_prometheus(METRICS_PROM, "rdmo_sync")
+
+
+def object_stats(git_dir: Path):
+    """(objets isolés, place occupée par les objets isolés, place occupée par les packs) d'un dépôt,
+    lus directement dans .git/objects sans lancer git. Les tailles sont la place sur disque (blocs)."""
+    loose = loose_bytes = pack_bytes = 0
+    try:
+        entries = list(os.scandir(git_dir / "objects"))
+    except FileNotFoundError:
+        return 0, 0, 0
+    for entry in entries:
+        if len(entry.name) == 2 and entry.is_dir():
+            for obj in os.scandir(entry.path):
+                loose += 1
+                loose_bytes += obj.stat().st_blocks * 512
+        elif entry.name == "pack":
+            pack_bytes += sum(f.stat().st_blocks * 512 for f in os.scandir(entry.path))
+    return loose, loose_bytes, pack_bytes
+
+
+def find_repos(root: Path):
+    """Dépôts git sous root : root lui-même (monorepo) et ses sous-dossiers directs (un dépôt par projet)."""
+    repos = [root] if (root / ".git").is_dir() else []
+    for entry in os.scandir(root):
+        if entry.is_dir() and not entry.name.startswith(".") and os.path.isdir(os.path.join(entry.path, ".git")):
+            repos.append(Path(entry.path))
+    return repos
+
+
+def maintain_repo(repo_path: Path, ionice):
+    """git gc (objets isolés rangés dans un pack, refs packées) puis commit-graph avec les chemins modifiés,
+    qui accélère `git log -- <chemin>`. Retourne (objets isolés en moins, octets libérés, durée)."""
+    git_dir = repo_path / ".git"
+    loose, loose_bytes, pack_bytes = object_stats(git_dir)
+    started = perf_counter()
+    with repo_lock(repo_path):
+        for command in (["-c", "gc.writeCommitGraph=false", "gc", "--quiet"],
+                        ["commit-graph", "write", "--reachable", "--changed-paths"]):
+            subprocess.run(ionice + ["git", "-C", str(repo_path), *command], check=True, stdout=subprocess.DEVNULL)
+    elapsed = perf_counter() - started
+    after_loose, after_loose_bytes, after_pack_bytes = object_stats(git_dir)
+    return loose - after_loose, loose_bytes + pack_bytes - after_loose_bytes - after_pack_bytes, elapsed
+
+
+def maintain_repos(root: Path, workers=MAINTENANCE_WORKERS, min_loose=MAINTENANCE_MIN_LOOSE, budget=MAINTENANCE_BUDGET):
+    """Maintenance de tous les dépôts sous root, workers à la fois, du plus chargé en objets isolés au moins chargé.
+    Les dépôts sous min_loose objets isolés sont laissés tels quels ; après budget secondes (0 : pas de limite)
+    aucun nouveau dépôt n'est commencé. Retourne le nombre de dépôts en échec."""
+    started = perf_counter()
+    with METRICS.timer("maintenance_scan"):
+        candidates = [(object_stats(repo / ".git")[0], repo) for repo in find_repos(root)]
+    todo = sorted((c for c in candidates if c[0] >= min_loose), key=lambda c: c[0])
+    print(f"[MAINTENANCE] {len(todo)} dépôt(s) sur {len(candidates)} avec au moins {min_loose} objets isolés")
+    # classe d'E/S "idle" : la maintenance ne passe qu'après les autres accès disque
+    ionice = ["ionice", "-c", "3"] if shutil.which("ionice") else []
+
+    done = packed = reclaimed = failures = 0
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while todo or running:
+            # todo est trié par nombre croissant d'objets isolés : pop() donne le dépôt le plus chargé
+            while todo and len(running) < workers and not STOP.is_set() and not (budget and perf_counter() - started > budget):
+                repo = todo.pop()[1]
+                running[executor.submit(maintain_repo, repo, ionice)] = repo
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                repo = running.pop(future)
+                try:
+                    repo_packed, repo_reclaimed, elapsed = future.result()
+                except Exception as e:
+                    failures += 1
+                    METRICS.inc("maintenance_failures")
+                    print(f"[ERREUR] Maintenance de {repo} : {e}")
+                    continue
+                done += 1
+                packed += repo_packed
+                reclaimed += repo_reclaimed
+                METRICS.observe("maintenance_repo", elapsed)
+
+    METRICS.inc("maintenance_repos", done)
+    METRICS.inc("maintenance_loose_objects_packed", packed)
+    METRICS.inc("maintenance_bytes_reclaimed", reclaimed)
+    if todo:
+        print(f"[SKIP] {len(todo)} dépôt(s) reporté(s) au prochain passage (budget de {budget:g} s atteint ou arrêt demandé)")
+    print(f"[RÉSUMÉ] Maintenance : {done} dépôt(s) en {perf_counter() - started:.1f} s, {packed} objets isolés rangés "
+          f"dans des packs, {reclaimed / 1e6:.1f} Mo libérés, {failures} échec(s)")
+    return failures
+
+
+def maintenance_if_due(db):
+    """En fin de cycle : maintenance de BASE_DIR si la dernière date de plus de MAINTENANCE_INTERVAL secondes."""
+    if not MAINTENANCE_INTERVAL or STOP.is_set():
+        return
+    last = get_meta(db, "maintenance_at")
+    now = datetime.now(timezone.utc)
+    if last and now - parse_date(last) < timedelta(seconds=MAINTENANCE_INTERVAL):
+        return
+    maintain_repos(BASE_DIR)
+    set_meta(db, "maintenance_at", now.isoformat())
+
+
+def project_id_of(name):
+    """Id du projet d'après le nom de son dossier (`<id>` ou `<id>_<titre>`), None si ce n'est pas un projet."""
+    match = re.match(r"\d+", name)
+    return int(match.group()) if match else None
+
+
+def head_sha(git_dir: Path):
+    """sha du commit HEAD lu dans .git sans lancer git (ref isolée ou packed-refs), None si le dépôt est vide."""
+    try:
+        head = (git_dir / "HEAD").read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    if not head.startswith("ref: "):
+        return head
+    ref = head[5:]
+    try:
+        return (git_dir / ref).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        pass
+    try:
+        with open(git_dir / "packed-refs", encoding="utf-8") as f:
+            for line in f:
+                if line.rstrip("\n").endswith(f" {ref}"):
+                    return line.split(" ", 1)[0]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def repo_commits(repo_path: Path, monorepo, since_sha=None):
+    """Commits de repo_path après since_sha, pour l'index : [(id du projet, sha, date, fichiers, None)].
+    Dans un monorepo le projet est donné par le premier dossier de chaque fichier, sinon par le dossier du dépôt.
+    La date est celle du commit (les exports la prennent dans RDMO)."""
+    revision = f"{since_sha}..HEAD" if since_sha else "HEAD"
+    result = subprocess.run(["git", "-C", str(repo_path), "log", "--format=%x00%H %aI", "--name-only", "--no-renames", revision],
+                            capture_output=True, text=True)
+    if result.returncode != 0 and since_sha:
+        # historique réécrit depuis la dernière indexation : on reprend tout le dépôt
+        return repo_commits(repo_path, monorepo)
+    if result.returncode != 0:
+        raise Exception(f"git log a échoué dans {repo_path} : {result.stderr.strip()}")
+
+    rows = []
+    for record in result.stdout.split("\0")[1:]:
+        header, *paths = [line for line in record.split("\n") if line]
+        sha, date = header.split(" ", 1)
+        projects = {}
+        for path in paths:
+            project_id = project_id_of(path.split("/", 1)[0]) if monorepo else project_id_of(repo_path.name)
+            if project_id is not None:
+                projects.setdefault(project_id, []).append(path)
+        for project_id, files in projects.items():
+            rows.append((project_id, sha, history_time(date), "\n".join(files), None))
+    return rows
+
+
+def reindex_history(root: Path, full=False):
+    """Complète l'index des commits de root depuis les dépôts (`reindex`) : seuls les dépôts dont HEAD a bougé
+    depuis le passage précédent sont relus, à partir du dernier commit indexé. Les commits déjà enregistrés
+    par la synchronisation ou les exports (date RDMO et hash) sont gardés. full vide l'index et relit tout l'historique."""
+    started = perf_counter()
+    history = open_history(root)
+    if full:
+        with history:
+            history.execute("DELETE FROM commits")
+            history.execute("DELETE FROM repos")
+    known = dict(history.execute("SELECT path, head FROM repos").fetchall())
+    todo = []
+    for repo in find_repos(root):
+        key = repo.relative_to(root).as_posix()
+        head = head_sha(repo / ".git")
+        if head and head != known.get(key):
+            todo.append((repo, key, head))
+
+    added = failures = 0
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        futures = {executor.submit(repo_commits, repo, repo == root, known.get(key)): (key, head) for repo, key, head in todo}
+        for future in as_completed(futures):
+            key, head = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"[ERREUR] Indexation de {key} : {e}")
+                continue
+            with history:
+                added += history.executemany("INSERT OR IGNORE INTO commits VALUES (?, ?, ?, ?, ?)", rows).rowcount
+                history.execute("INSERT OR REPLACE INTO repos (path, head) VALUES (?, ?)", (key, head))
+    history.close()
+    print(f"[RÉSUMÉ] Index : {added} commit(s) ajouté(s) depuis {len(todo)} dépôt(s) modifié(s), "
+          f"en {perf_counter() - started:.1f} s, {failures} échec(s)")
+    return failures
+
+
+def project_history(history, project_id, since=None, until=None):
+    """Commits d'un projet dans l'index, du plus récent au plus ancien, avec since <= date < until."""
+    return history.execute(
+        "SELECT * FROM commits WHERE project_id = ? AND changed_at >= ? AND changed_at < ? ORDER BY changed_at DESC",
+        (project_id, history_time(since) if since else "", history_time(until) if until else "~")
+    ).fetchall()
+
+
+def last_change(history, project_id):
+    """Dernier commit d'un projet dans l'index, None s'il n'y en a pas."""
+    return history.execute(
+        "SELECT * FROM commits WHERE project_id = ? ORDER BY changed_at DESC LIMIT 1", (project_id,)
+    ).fetchone()
+
+
+def changed_projects(history, since=None, until=None):
+    """Projets modifiés avec since <= date < until : lignes (project_id, commits, first_change, last_change)."""
+    return history.execute("""
+        SELECT project_id, COUNT(*) AS commits, MIN(changed_at) AS first_change, MAX(changed_at) AS last_change
+        FROM commits WHERE changed_at >= ? AND changed_at < ?
+        GROUP BY project_id ORDER BY last_change DESC
+    """, (history_time(since) if since else "", history_time(until) if until else "~")).fetchall()
+
+
+def open_sync_state():
+    """Ouvre la base d'état dans BASE_DIR, en reprenant l'ancien fichier de référence au premier passage."""
+    BASE_DIR.mkdir(parents=True, exist_ok=True)
+    db = open_state(BASE_DIR / STATE_DB)
+    if not MONOREPO and Path(OLD_LISTE_FILE).exists() and db.execute("SELECT COUNT(*) FROM projects").fetchone()[0] == 0:
+        print(f"[INFO] Import de l'état existant depuis {OLD_LISTE_FILE}")
+        import_legacy_listing(db, OLD_LISTE_FILE)
+    return db
+
+
+def list_projects(db, full=False):
+    """Liste les projets de l'API et met à jour la base d'état, sans rien télécharger.
+    En mode incrémental, seuls les projets modifiés depuis le watermark sont demandés à l'API.
+    Retourne (date du listing, nombre de projets listés)."""
+    listed_at = datetime.now(timezone.utc).isoformat()
+    watermark = None if full else get_meta(db, "watermark")
+    if watermark:
+        print(f"[INFO] Synchronisation incrémentale depuis {watermark}")
+        count = record_listing(db, iter_changed_projects(watermark), listed_at)
+    else:
+        count = record_listing(db, iter_remote_projects(), listed_at)
+    return listed_at, count
+
+
+def sync_once(db, full=False, batch=None):
+    """Un cycle de synchronisation. Retourne (succès, échecs)."""
+    # Étape 1 : Lister les projets et mettre à jour la base d'état
+    listed_at, count = list_projects(db, full)
+
+    # Étape 2 : Choisir les projets à télécharger (nouveaux, modifiés ou en échec au passage précédent)
+    todo = pending_projects(db, listed_at)
+    for row in todo:
+        if row["synced_changed"] is None:
+            print(f"[INIT] Téléchargement du projet {row['title']}")
+        else:
+            print(f"[UPDATE] {row['title']} a changé ({row['synced_changed']} -> {row['last_changed']})")
+    print(f"[SKIP] {count - len(todo)} projet(s) pas modifié(s)")
+
+    # Étape 3 : Téléchargements et commits en parallèle, état enregistré projet par projet
+    successes, failures = sync_projects(db, todo, batch)
+    update_watermark(db, listed_at)
+
+    # Étape 4 : Maintenance des dépôts si elle est due (RDMO_MAINTENANCE_INTERVAL)
+    maintenance_if_due(db)
+    return successes, failures
+
+
+def sync_project_ids(db, project_ids, batch=None):
+    """Synchronise seulement les projets notifiés par le webhook : leur fiche est relue dans l'API,
+    puis téléchargement et commit comme dans un cycle. Le watermark n'est pas modifié. Retourne (succès, échecs)."""
+    listed_at = datetime.now(timezone.utc).isoformat()
+    projects = []
+    for project_id in project_ids:
+        try:
+            projects.append(api_get(f"{LISTE_PROJET_URL}{project_id}/").json())
+        except Exception as e:
+            print(f"[ERREUR] Projet notifié {project_id} : {e}")
+    record_listing(db, projects, listed_at)
+    mark_pending(db, [proj["id"] for proj in projects])
+    todo = pending_projects(db, listed_at)
+    for row in todo:
+        print(f"[UPDATE] {row['title']} notifié")
+    return sync_projects(db, todo, batch)
+
+
+class ProjectEvents:
+    """Projets notifiés en attente de synchronisation. Les notifications répétées d'un projet sont
+    fusionnées : il est prêt quand aucune nouvelle notification n'est arrivée depuis delay secondes."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = Lock()
+        self.last_seen = {}
+
+    def add(self, project_id):
+        with self.lock:
+            self.last_seen[project_id] = monotonic()
+        WAKE.set()
+
+    def pop_ready(self):
+        now = monotonic()
+        with self.lock:
+            ready = [pid for pid, seen in self.last_seen.items() if now - seen >= self.delay]
+            for pid in ready:
+                del self.last_seen[pid]
+        return ready
+
+    def next_ready(self):
+        """Secondes avant que le prochain projet soit prêt, None s'il n'y en a pas."""
+        with self.lock:
+            if not self.last_seen:
+                return None
+            return max(0.0, min(self.last_seen.values()) + self.delay - monotonic())
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """POST /projects/<id> : le projet <id> a changé (le corps de la requête est ignoré)."""
+    events = None
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if WEBHOOK_TOKEN and not hmac.compare_digest(self.headers.get("X-Webhook-Token", ""), WEBHOOK_TOKEN):
+            return self.reply(403, "forbidden")
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "projects" or not parts[1].isdigit():
+            return self.reply(404, "POST /projects/<id>")
+        self.events.add(int(parts[1]))
+        self.reply(202, "accepted")
+
+    def reply(self, code, message):
+        body = f"{message}\n".encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print(f"[WEBHOOK] {self.address_string()} {format % args}")
+
+
+def start_webhook(events):
+    """Lance le serveur de notifications dans un thread. Retourne le serveur (à arrêter par shutdown())."""
+    handler = type("Handler", (WebhookHandler,), {"events": events})
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Notifications acceptées sur http://{WEBHOOK_HOST}:{WEBHOOK_PORT}/projects/<id>")
+    return server
+
+
+@contextmanager
+def run_lock(path):
+    """Verrou fichier (flock) contre deux synchronisations simultanées. Donne False s'il est déjà pris."""
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run_once():
+    """Un seul cycle (appel depuis cron). Retourne le code de sortie du script."""
+    BASE_DIR.mkdir(parents=True, exist_ok=True)
+    with run_lock(BASE_DIR / RUN_LOCK_FILE) as acquired:
+        if not acquired:
+            print("[SKIP] Une synchronisation est déjà en cours")
+            return 0
+        db = open_sync_state()
+        successes, failures = sync_once(db, FULL_SYNC)
+        db.close()
+    print_summary(successes, failures)
+    return 1 if failures else 0
+
+
+def request_stop(signum, frame):
+    """SIGTERM/SIGINT : fin propre après les projets en cours. Un second signal arrête immédiatement."""
+    print(f"[INFO] Signal {signal.Signals(signum).name} reçu, arrêt après les projets en cours")
+    STOP.set()
+    WAKE.set()
+    signal.signal(signum, signal.SIG_DFL)
+
+
+def serve(interval=POLL_INTERVAL):
+    """Mode démon : un cycle toutes les interval secondes dans le même processus. La session HTTP
+    (connexions keep-alive), le limiteur de débit, la base d'état et le dépôt monorepo restent ouverts
+    d'un cycle à l'autre ; seul le premier cycle fait un listing complet si RDMO_FULL_SYNC est demandé.
+    Avec RDMO_WEBHOOK_PORT, les projets notifiés sont synchronisés entre deux cycles, sans attendre le suivant."""
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    db = open_sync_state()
+    batch = MonorepoBatch(BASE_DIR, BATCH_SIZE) if MONOREPO else None
+    events = ProjectEvents(WEBHOOK_DELAY) if WEBHOOK_PORT else None
+    server = start_webhook(events) if events else None
+    print(f"[INFO] Démon démarré : un cycle toutes les {interval:g} s dans {BASE_DIR}")
+
+    def locked(sync, *args):
+        """Exécute sync(db, *args) sous le verrou de synchronisation. Retourne True si elle a abouti."""
+        with run_lock(BASE_DIR / RUN_LOCK_FILE) as acquired:
+            if not acquired:
+                print("[SKIP] Une synchronisation est déjà en cours, cycle sauté")
+                return False
+            try:
+                print_summary(*sync(db, *args))
+                return True
+            except Exception as e:
+                # une erreur (API indisponible...) ne doit pas arrêter le démon
+                print(f"[ERREUR] Cycle de synchronisation : {e}")
+                traceback.print_exc()
+                return False
+
+    full = FULL_SYNC
+    next_cycle = monotonic()
+    while not STOP.is_set():
+        if monotonic() >= next_cycle:
+            next_cycle = monotonic() + interval
+            if locked(sync_once, full, batch):
+                full = False
+        ready = events.pop_ready() if events else []
+        if ready and not STOP.is_set():
+            locked(sync_project_ids, ready, batch)
+
+        timeout = next_cycle - monotonic()
+        if events and events.next_ready() is not None:
+            timeout = min(timeout, events.next_ready())
+        WAKE.wait(max(0.0, timeout))
+        WAKE.clear()
+
+    if server is not None:
+        server.shutdown()
+    db.close()
+    print("[INFO] Démon arrêté")
 
 ##########################################################################################################################################################################################################################################################################################
 ####   Début du script
 ##########################################################################################################################################################################################################################################################################################
 
 
-# Étape 1 : Télécharger tous les projets paginés
-fetch_all_projects()
-
-# Étape 2 : Extraire les projets
-projects = parse_projects(LISTE_FILE)
-
-# Étape 3 : Vérifier si old_liste_projet.json existe
-if not Path(OLD_LISTE_FILE).exists():
-    shutil.move(LISTE_FILE, OLD_LISTE_FILE)
-    for pid, info in projects.items():
-        print(f"[INIT] Téléchargement du projet {info['title']}")
-        download_and_commit_project(pid, info["title"])
-else:
-    old_projects = parse_projects(OLD_LISTE_FILE)
-    for pid, info in projects.items():
-        title = info["title"]
-        new_date = info["last_changed"]
-        old_date = old_projects.get(pid, {}).get("last_changed")
-
-        if old_date != new_date:
-            print(f"[UPDATE] {title} a changé ({old_date} -> {new_date})")
-            download_and_commit_project(pid, title)
+def check_api_env():
+    """Vérifie que TOKENRDMO et MYRDMO sont définis (et RDMO_VALUES_LAYOUT valide) avant une commande qui appelle l'API."""
+    missing = [name for name, value in (("TOKENRDMO", TOKEN), ("MYRDMO", MYRDMO)) if not value]
+    if missing:
+        print(f"[ERREUR] Variable(s) d'environnement manquante(s) : {', '.join(missing)}")
+        return False
+    if VALUES_LAYOUT not in VALUES_LAYOUTS:
+        print(f"[ERREUR] RDMO_VALUES_LAYOUT={VALUES_LAYOUT} : valeurs possibles {', '.join(VALUES_LAYOUTS)}")
+        return False
+    return True
+
+
+def list_command(full=False):
+    """`list` : met à jour la base d'état avec le listing de l'API et affiche les projets à synchroniser,
+    sans rien télécharger ni commiter."""
+    db = open_sync_state()
+    listed_at, count = list_projects(db, full)
+    todo = pending_projects(db, listed_at)
+    for row in todo:
+        print(f"[UPDATE] {row['id']} {row['title']} ({row['synced_changed'] or 'jamais synchronisé'} -> {row['last_changed']})")
+    print(f"[RÉSUMÉ] {count} projet(s) listé(s), {len(todo)} à synchroniser")
+    db.close()
+    return 0
+
+
+def status_command():
+    """`status` : état de la base d'état locale (aucun appel réseau, ni git)."""
+    path = BASE_DIR / STATE_DB
+    if not path.exists():
+        print(f"[INFO] Pas encore de base d'état dans {BASE_DIR}")
+        return 0
+    db = open_state(path)
+    counts = dict(db.execute("SELECT status, COUNT(*) FROM projects GROUP BY status").fetchall())
+    last_sync = db.execute("SELECT MAX(synced_at) FROM projects").fetchone()[0]
+    failed = db.execute("SELECT id, title, error FROM projects WHERE status = 'failed' ORDER BY id").fetchall()
+    print(f"[INFO] Base d'état : {path}")
+    print(f"[INFO] Watermark : {get_meta(db, 'watermark') or 'aucun (prochain listing complet)'}")
+    print(f"[INFO] Dernière synchronisation réussie : {last_sync or 'aucune'}")
+    print(f"[RÉSUMÉ] {sum(counts.values())} projet(s) : " + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+    for row in failed:
+        print(f"         - {row['id']} {row['title']} : {row['error']}")
+    db.close()
+    return 1 if failed else 0
+
+
+def maintain_command(root, workers, min_loose, budget):
+    """`maintain` : maintenance des dépôts sous root (BASE_DIR par défaut, ou un dossier d'exports),
+    sous le verrou de synchronisation pour ne pas tourner pendant un cycle."""
+    root = Path(root).resolve()
+    with run_lock(root / RUN_LOCK_FILE) as acquired:
+        if not acquired:
+            print("[SKIP] Une synchronisation est en cours, maintenance reportée")
+            return 0
+        failures = maintain_repos(root, workers, min_loose, budget)
+    METRICS.print_summary()
+    if METRICS_JSON:
+        METRICS.write_json(METRICS_JSON)
+    if METRICS_PROM:
+        METRICS.write_prometheus(METRICS_PROM, "rdmo_maintenance")
+    return 1 if failures else 0
+
+
+def history_command(root, project_id=None, since=None, until=None, last=False, as_json=False):
+    """`history` : interroge l'index des commits de root (voir reindex_history), sans lancer git."""
+    path = Path(root) / HISTORY_DB
+    if not path.exists():
+        print(f"[ERREUR] Pas d'index dans {root}, lancer `reindex` d'abord")
+        return 1
+    started = perf_counter()
+    history = open_history(Path(root))
+    if project_id is not None and last:
+        row = last_change(history, project_id)
+        rows = [row] if row else []
+    elif project_id is not None:
+        rows = project_history(history, project_id, since, until)
+    else:
+        rows = changed_projects(history, since, until)
+    elapsed = perf_counter() - started
+    history.close()
+
+    if as_json:
+        print(json.dumps([dict(row) for row in rows], indent=2))
+        return 0
+    for row in rows:
+        if project_id is not None:
+            files = ", ".join(row["files"].split("\n"))
+            print(f"{row['changed_at']}  {row['commit_sha'][:10]}  {files}")
         else:
-            print(f"[SKIP] {title} pas modifié")
+            print(f"{row['project_id']:>8}  {row['commits']:>4} commit(s)  {row['first_change']} -> {row['last_change']}")
+    print(f"[INFO] {len(rows)} résultat(s) en {elapsed * 1000:.1f} ms")
+    return 0
+
+
+def export_command(path, options, app_dir, settings):
+    """`export` : export XML par l'ORM (gp_export_projects.run), comme `manage.py runscript`. L'export indexe
+    ses commits au fil de l'eau ; reindex ne fait ensuite que compléter l'index avec les commits antérieurs des
+    dépôts exportés. Django et rdmo-app ne sont chargés que pour cette commande."""
+    sys.path.insert(0, str(Path(app_dir).resolve()))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings)
+    import django
+    django.setup()
+    import gp_export_projects
+    gp_export_projects.run(path, *options)
+    return 1 if reindex_history(Path(path).resolve()) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synchronisation des projets RDMO (API) dans des dépôts git locaux")
+    commands = parser.add_subparsers(dest="command", metavar="commande")
+    commands.add_parser("sync", help="un cycle de synchronisation (commande par défaut, pour cron)")
+    serve_parser = commands.add_parser("serve", help="mode démon, un cycle toutes les INTERVALLE secondes")
+    serve_parser.add_argument("interval", nargs="?", type=float, default=POLL_INTERVAL, metavar="INTERVALLE")
+    list_parser = commands.add_parser("list", help="liste les projets de l'API et ceux à synchroniser, sans télécharger")
+    list_parser.add_argument("--full", action="store_true", help="listing complet au lieu de l'incrémental")
+    commands.add_parser("status", help="état de la base d'état locale, sans appel réseau")
+    maintain_parser = commands.add_parser("maintain", help="git gc et commit-graph des dépôts, les plus chargés d'abord")
+    maintain_parser.add_argument("root", nargs="?", default=BASE_DIR, help="dossier des dépôts (par défaut celui de la synchronisation)")
+    maintain_parser.add_argument("--workers", type=int, default=MAINTENANCE_WORKERS, help="dépôts traités en même temps")
+    maintain_parser.add_argument("--min-loose", type=int, default=MAINTENANCE_MIN_LOOSE, help="objets isolés à partir desquels un dépôt est traité")
+    maintain_parser.add_argument("--budget", type=float, default=MAINTENANCE_BUDGET, help="secondes après lesquelles plus aucun dépôt n'est commencé")
+    history_parser = commands.add_parser("history", help="historique des projets depuis l'index des commits")
+    history_parser.add_argument("--root", default=BASE_DIR, help="dossier des dépôts (par défaut celui de la synchronisation)")
+    history_parser.add_argument("--project", type=int, help="commits de ce projet (sinon : projets modifiés)")
+    history_parser.add_argument("--since", help="date ISO 8601 de début (incluse)")
+    history_parser.add_argument("--until", help="date ISO 8601 de fin (exclue)")
+    history_parser.add_argument("--last", action="store_true", help="seulement le dernier commit du projet")
+    history_parser.add_argument("--json", action="store_true", help="résultat en JSON")
+    reindex_parser = commands.add_parser("reindex", help="complète l'index des commits depuis les dépôts git")
+    reindex_parser.add_argument("root", nargs="?", default=BASE_DIR, help="dossier des dépôts (sync ou exports)")
+    reindex_parser.add_argument("--full", action="store_true", help="vide l'index et relit tout l'historique")
+    export_parser = commands.add_parser("export", help="export XML par l'ORM de rdmo-app (gp_export_projects)")
+    export_parser.add_argument("path", help="dossier des exports")
+    export_parser.add_argument("options", nargs="*", help="options du runscript : full, workers=N, monorepo...")
+    export_parser.add_argument("--app", default=os.environ.get("RDMO_APP", "."), help="dossier de rdmo-app (RDMO_APP)")
+    export_parser.add_argument("--settings", default="config.settings", help="module de settings Django")
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        return status_command()
+    if args.command == "maintain":
+        return maintain_command(args.root, args.workers, args.min_loose, args.budget)
+    if args.command == "history":
+        return history_command(args.root, args.project, args.since, args.until, args.last, args.json)
+    if args.command == "reindex":
+        return 1 if reindex_history(Path(args.root).resolve(), args.full) else 0
+    if args.command == "export":
+        return export_command(args.path, args.options, args.app, args.settings)
+    if not check_api_env():
+        return 2
+    if args.command == "list":
+        return list_command(args.full)
+    if args.command == "serve":
+        serve(args.interval)
+        return 0
+    return run_once()
+
 
-    # Mise à jour du fichier de référence
-    shutil.copyfile(LISTE_FILE, OLD_LISTE_FILE)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())